@@ -0,0 +1,316 @@
+# coding: utf-8
+"""
+Offline CPU benchmark of the demix functions of inference.py.
+
+Models are built from tiny configs with random weights and the ONNX MDX model is replaced by a small
+stand-in graph, so nothing is downloaded and no GPU is needed:
+
+    python -m benchmarks.demix_benchmark [--seconds 10] [--threads 1 4] [--only bs_roformer] [--json out.json]
+
+Every case reports the wall time, the real-time factor (wall seconds per second of audio, as 'rtf' in
+the --report files of inference.py), chunks per second and how far the resident memory of the process
+rose above its level at the start of the case (the JSON also has the absolute peak).
+Timings of tiny models mostly measure the chunking, STFT and overlap-add code around the model, which
+is what changes in inference.py are about.
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+import threading
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import onnxruntime as ort
+
+import inference
+from modules.tfc_tdf_v2 import Conv_TDF_net_trim_model
+
+
+SAMPLE_RATE = 44100
+
+# Same layout as the yaml files of the real models, only much smaller
+CONFIGS = {
+    'bs_roformer': """
+audio:
+  chunk_size: 131584
+  dim_t: 256
+  hop_length: 441
+  n_fft: 2048
+  num_channels: 2
+  sample_rate: 44100
+model:
+  dim: 32
+  depth: 1
+  stereo: true
+  num_stems: 1
+  time_transformer_depth: 1
+  freq_transformer_depth: 1
+  dim_head: 16
+  heads: 2
+  attn_dropout: 0.0
+  ff_dropout: 0.0
+  flash_attn: true
+  dim_freqs_in: 1025
+  stft_n_fft: 2048
+  stft_hop_length: 441
+  stft_win_length: 2048
+  stft_normalized: false
+  mask_estimator_depth: 1
+training:
+  instruments:
+  - vocals
+  - other
+  target_instrument: vocals
+inference:
+  batch_size: 1
+  dim_t: 256
+  num_overlap: 2
+""",
+    'mdx23c': """
+audio:
+  chunk_size: 130560
+  dim_f: 512
+  dim_t: 256
+  hop_length: 512
+  n_fft: 2048
+  num_channels: 2
+  sample_rate: 44100
+model:
+  act: gelu
+  bottleneck_factor: 2
+  growth: 8
+  norm: InstanceNorm
+  num_blocks_per_scale: 1
+  num_channels: 16
+  num_scales: 2
+  num_subbands: 2
+  scale:
+  - 2
+  - 2
+training:
+  instruments:
+  - Vocals
+  - Instrumental
+  target_instrument: null
+inference:
+  batch_size: 1
+  dim_t: 256
+  num_overlap: 2
+""",
+    'segm_models': """
+audio:
+  chunk_size: 130560
+  dim_f: 512
+  dim_t: 256
+  hop_length: 512
+  n_fft: 2048
+  num_channels: 2
+  sample_rate: 44100
+model:
+  encoder_name: resnet18
+  encoder_weights: null
+  decoder_type: unet
+  act: gelu
+  num_channels: 16
+  num_subbands: 4
+training:
+  instruments:
+  - vocals
+  - other
+  target_instrument: null
+inference:
+  batch_size: 1
+  dim_t: 128
+  num_overlap: 2
+""",
+}
+
+# Conv_TDF_net_trim_model of the stand-in ONNX graph, dim_t is always 256
+MDX_N_FFT = 2048
+MDX_HOP = 512
+MDX_DIM_F = 512
+
+
+class StandInMDX(nn.Module):
+    """ Spectrogram in, spectrogram out, like the real MDX ONNX models """
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv2d(4, 4, 3, padding=1)
+
+    def forward(self, x):
+        return torch.tanh(self.conv(x)) * x
+
+
+def build_model(name, folder):
+    """ Random-weight model and its config, built through the same code as the real models """
+    config_path = os.path.join(folder, name + '.yaml')
+    with open(config_path, 'w') as f:
+        f.write(CONFIGS[name])
+    torch.manual_seed(0)
+    model, config = inference.get_model_from_config(name, config_path)
+    return model.eval(), config
+
+
+def build_onnx(folder, threads):
+    path = os.path.join(folder, 'stand_in_mdx.onnx')
+    if not os.path.isfile(path):
+        torch.manual_seed(0)
+        torch.onnx.export(
+            StandInMDX().eval(), torch.zeros(1, 4, MDX_DIM_F, 256), path,
+            input_names=['input'], output_names=['output'],
+            dynamic_axes={'input': {0: 'batch_size'}, 'output': {0: 'batch_size'}}, dynamo=False,
+        )
+    session_options = ort.SessionOptions()
+    session_options.intra_op_num_threads = threads
+    session = ort.InferenceSession(path, session_options, providers=['CPUExecutionProvider'])
+    model = Conv_TDF_net_trim_model(device='cpu', target_name='vocals', L=11, n_fft=MDX_N_FFT, hop=MDX_HOP, dim_f=MDX_DIM_F)
+    return [model], session
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class PeakMemory:
+    """ Highest resident set size of the process while the block runs, sampled every `interval` seconds """
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.start = self.peak = 0
+        self.done = threading.Event()
+
+    def sample(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, rss())
+
+    def __enter__(self):
+        self.start = self.peak = rss()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, rss())
+
+
+def build_cases(args, models, onnx_model):
+    """ (name, parameters, function of the mix) of every case """
+    cases = []
+    for name in ('bs_roformer', 'mdx23c'):
+        model, config = models[name]
+        for dim_t in args.dim_t:
+            for batch_size in args.batch_sizes:
+                cases.append(('demix_new/' + name, {'dim_t': dim_t, 'batch_size': batch_size},
+                              lambda mix, m=model, c=config, d=dim_t, b=batch_size:
+                              inference.demix_new(m, mix, 'cpu', c, dim_t=d, batch_size=b)))
+
+    model, config = models['segm_models']
+    for dim_t in args.dim_t:
+        for batch_size in args.batch_sizes:
+            # demix_vitlarge chunks have 2 * inference.dim_t frames
+            def run(mix, m=model, d=dim_t, b=batch_size):
+                m.config.inference.dim_t = d // 2
+                return inference.demix_vitlarge(m, torch.from_numpy(mix), 'cpu', batch_size=b)
+            cases.append(('demix_vitlarge/segm_models', {'dim_t': dim_t, 'batch_size': batch_size}, run))
+
+    mdx_models, session = onnx_model
+    for overlap in args.overlaps:
+        for batch_size in args.batch_sizes:
+            cases.append(('demix/onnx', {'overlap': overlap, 'batch_size': batch_size},
+                          lambda mix, o=overlap, b=batch_size:
+                          inference.demix(mix, 'cpu', mdx_models, session, overlap=o, batch_size=b)))
+
+    batch_size = max(args.batch_sizes)
+    for single_pass in (False, True):
+        parameters = {'bigshifts': args.bigshifts, 'batch_size': batch_size, 'single_pass': single_pass}
+        model, config = models['bs_roformer']
+        cases.append(('demix_new_wrapper/bs_roformer', dict(parameters, dim_t=max(args.dim_t)),
+                      lambda mix, m=model, c=config, s=single_pass:
+                      inference.demix_new_wrapper(mix, 'cpu', m, c, dim_t=max(args.dim_t), batch_size=batch_size, single_pass=s)))
+        model, config = models['segm_models']
+
+        def run(mix, m=model, s=single_pass):
+            m.config.inference.dim_t = max(args.dim_t) // 2
+            return inference.demix_full_vitlarge(mix, 'cpu', m, batch_size=batch_size, single_pass=s)
+        cases.append(('demix_full_vitlarge/segm_models', dict(parameters, dim_t=max(args.dim_t)), run))
+        cases.append(('demix_wrapper/onnx', dict(parameters, overlap=args.overlaps[0]),
+                      lambda mix, s=single_pass:
+                      inference.demix_wrapper(mix, 'cpu', mdx_models, session, overlap=args.overlaps[0],
+                                              bigshifts=args.bigshifts, batch_size=batch_size, single_pass=s)))
+
+    return [case for case in cases if not args.only or any(o in case[0] for o in args.only)]
+
+
+def run_case(fn, mix, repeat):
+    """ Best wall time over `repeat` runs, the chunks of one run and the peak memory over all of them """
+    best = None
+    with PeakMemory() as memory:
+        for _ in range(repeat):
+            inference._progress.tracker = inference.Progress()
+            start = time.perf_counter()
+            fn(mix)
+            duration = time.perf_counter() - start
+            chunks = inference._progress.tracker.stage_chunks
+            inference._progress.tracker = None
+            best = duration if best is None else min(best, duration)
+    return best, chunks, memory
+
+
+def main():
+    m = argparse.ArgumentParser(description='Offline CPU benchmark of the demix functions with tiny random-weight models')
+    m.add_argument("--seconds", type=float, help="Length of the synthetic stereo mix", default=10.0)
+    m.add_argument("--threads", type=int, nargs='+', help="Torch and ONNX Runtime thread counts to run every case with", default=[1])
+    m.add_argument("--batch_sizes", type=int, nargs='+', help="Batch sizes", default=[1, 4])
+    m.add_argument("--dim_t", type=int, nargs='+', help="Chunk sizes in STFT frames (multiples of 32)", default=[64, 256])
+    m.add_argument("--overlaps", type=float, nargs='+', help="Overlaps of the ONNX demix", default=[0.2, 0.5])
+    m.add_argument("--bigshifts", type=int, help="BigShifts of the wrapper cases", default=2)
+    m.add_argument("--repeat", type=int, help="Runs per case, the fastest one is reported", default=1)
+    m.add_argument("--only", type=str, nargs='+', help="Run only the cases whose name contains one of these")
+    m.add_argument("--json", type=str, help="Also write the results to this JSON file")
+    args = m.parse_args()
+
+    rng = np.random.default_rng(0)
+    mix = (0.1 * rng.standard_normal((2, int(args.seconds * SAMPLE_RATE)))).astype(np.float32)
+
+    # the BigShifts wrappers read it from the module options
+    inference.options = {'BigShifts': args.bigshifts}
+    folder = tempfile.mkdtemp(prefix='demix_benchmark_')
+    models = {name: build_model(name, folder) for name in CONFIGS}
+
+    print('torch {}, onnxruntime {}, {} CPUs, mix of {:.1f} s'.format(torch.__version__, ort.__version__, os.cpu_count(), args.seconds))
+    print('{:<34} {:<58} {:>8} {:>8} {:>9} {:>9} {:>9}'.format('case', 'parameters', 'threads', 'seconds', 'RTF', 'chunks/s', '+peak MB'))
+    results = []
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        onnx_model = build_onnx(folder, threads)
+        for name, parameters, fn in build_cases(args, models, onnx_model):
+            # first calls build windows and chunk plans and warm up the allocators, they aren't measured
+            fn(mix[:, :SAMPLE_RATE * 2])
+            duration, chunks, memory = run_case(fn, mix, args.repeat)
+            result = {
+                'case': name, 'parameters': parameters, 'threads': threads, 'seconds': duration,
+                'rtf': duration / args.seconds, 'chunks': chunks, 'chunks_per_sec': chunks / duration,
+                'peak_rss_mb': memory.peak / 2 ** 20, 'peak_rss_increase_mb': (memory.peak - memory.start) / 2 ** 20,
+            }
+            results.append(result)
+            print('{:<34} {:<58} {:>8} {:>8.2f} {:>9.3f} {:>9.1f} {:>9.0f}'.format(
+                name, ', '.join('{}={}'.format(k, v) for k, v in parameters.items()), threads, duration,
+                result['rtf'], result['chunks_per_sec'], result['peak_rss_increase_mb']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'torch': torch.__version__, 'onnxruntime': ort.__version__, 'platform': platform.platform(),
+                'cpus': os.cpu_count(), 'audio_seconds': args.seconds, 'results': results,
+            }, f, indent=2)
+        print('Results written to {}'.format(args.json))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+# coding: utf-8
+"""
+Microbenchmark of the BS-Roformer building blocks, each block timed on its own with the shapes of a real
+chunk (62 bands, dim_t of 1101 frames, stereo) and random weights:
+
+    python -m benchmarks.roformer_blocks [--dim 512 --heads 8 --dim_head 64] [--paths flash einsum] [--json out.json]
+
+Blocks: STFT, iSTFT, BandSplit, the time and frequency Transformer layers, Attend alone on the time and
+frequency axes, MaskEstimator and the whole forward. Blocks with attention are timed once per attention
+path (Attend.flash on and off). Memory is the peak from torch.cuda.max_memory_allocated on CUDA. On CPU it is
+the sum of what every operator of one run allocates, counted by torch.profiler with profile_memory, so
+buffers the allocator reuses from earlier runs count as well.
+The einsum path keeps (bands * heads, dim_t, dim_t) attention matrices, about 5 GB for the time axis with
+the default shapes.
+"""
+import argparse
+import json
+import statistics
+import time
+
+import torch
+
+from modules.bs_roformer import BSRoformer
+from modules.bs_roformer.attend import Attend
+
+
+def build_model(args):
+    torch.manual_seed(0)
+    model = BSRoformer(
+        dim=args.dim,
+        depth=1,
+        stereo=True,
+        num_stems=1,
+        time_transformer_depth=1,
+        freq_transformer_depth=1,
+        dim_head=args.dim_head,
+        heads=args.heads,
+        stft_n_fft=2048,
+        stft_hop_length=args.hop_length,
+        stft_win_length=2048,
+        mask_estimator_depth=args.mask_estimator_depth,
+    )
+    return model.eval().to(args.device)
+
+
+def set_attention_path(model, flash):
+    for module in model.modules():
+        if isinstance(module, Attend):
+            module.flash = flash
+
+
+def allocated(fn):
+    """ Bytes allocated by the operators of one run of fn on CPU, an operator counts what it still holds when it returns """
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return sum(max(event.self_cpu_memory_usage, 0) for event in prof.events() if event.name != '[memory]')
+
+
+def measure(fn, args):
+    """ Median and fastest time of `repeat` runs after one warm-up run, and the memory in MB """
+    device = torch.device(args.device)
+    fn()
+    times = []
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        start_memory = torch.cuda.memory_allocated()
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    if device.type == 'cuda':
+        memory = torch.cuda.max_memory_allocated() - start_memory
+    else:
+        # profiled on its own, the profiler would slow down the timed runs
+        memory = allocated(fn)
+    return statistics.median(times), min(times), memory / 2 ** 20
+
+
+def build_blocks(model, args):
+    """ (block name, True if it has attention, input shape, function) of every block """
+    device = args.device
+    bands = len(model.band_split.dim_inputs)
+    samples = args.hop_length * (args.dim_t - 1)
+    audio = torch.randn(args.batch, 2, samples, device=device)
+
+    stft_window = model.stft_window_fn(device=device)
+    stft_input = audio.reshape(-1, samples)
+    spec = torch.stft(stft_input, **model.stft_kwargs, window=stft_window, return_complex=True)
+    frames = spec.shape[-1]
+    band_input = torch.randn(args.batch, frames, sum(model.band_split.dim_inputs), device=device)
+    features = torch.randn(args.batch, frames, bands, args.dim, device=device)
+    time_transformer, freq_transformer = model.layers[0]
+    time_input = features.transpose(1, 2).reshape(args.batch * bands, frames, args.dim)
+    freq_input = features.reshape(args.batch * frames, bands, args.dim)
+    time_qkv = torch.randn(3, args.batch * bands, args.heads, frames, args.dim_head, device=device)
+    freq_qkv = torch.randn(3, args.batch * frames, args.heads, bands, args.dim_head, device=device)
+    attend = time_transformer.layers[0][0].attend
+
+    return [
+        ('stft', False, tuple(stft_input.shape),
+         lambda: torch.stft(stft_input, **model.stft_kwargs, window=stft_window, return_complex=True)),
+        ('istft', False, tuple(spec.shape),
+         lambda: torch.istft(spec, **model.stft_kwargs, window=stft_window, return_complex=False)),
+        ('band_split', False, tuple(band_input.shape), lambda: model.band_split(band_input)),
+        ('time_transformer', True, tuple(time_input.shape), lambda: time_transformer(time_input)),
+        ('freq_transformer', True, tuple(freq_input.shape), lambda: freq_transformer(freq_input)),
+        ('attend_time', True, tuple(time_qkv.shape[1:]), lambda: attend(*time_qkv)),
+        ('attend_freq', True, tuple(freq_qkv.shape[1:]), lambda: attend(*freq_qkv)),
+        ('mask_estimator', False, tuple(features.shape), lambda: model.mask_estimators[0](features)),
+        ('forward', True, tuple(audio.shape), lambda: model(audio)),
+    ]
+
+
+def main():
+    m = argparse.ArgumentParser(description='Microbenchmark of the BS-Roformer blocks with random weights')
+    m.add_argument("--dim", type=int, help="Model dimension", default=512)
+    m.add_argument("--heads", type=int, help="Attention heads", default=8)
+    m.add_argument("--dim_head", type=int, help="Dimension of an attention head", default=64)
+    m.add_argument("--mask_estimator_depth", type=int, help="Layers of every mask estimator MLP", default=2)
+    m.add_argument("--dim_t", type=int, help="STFT frames per chunk", default=1101)
+    m.add_argument("--hop_length", type=int, help="STFT hop length", default=441)
+    m.add_argument("--batch", type=int, help="Chunks per batch", default=1)
+    m.add_argument("--repeat", type=int, help="Timed runs per block", default=3)
+    m.add_argument("--threads", type=int, help="Torch threads, default is torch's own choice")
+    m.add_argument("--device", type=str, help="Device to run on", default='cpu')
+    m.add_argument("--paths", type=str, nargs='+', choices=['flash', 'einsum'], help="Attention paths", default=['flash', 'einsum'])
+    m.add_argument("--only", type=str, nargs='+', help="Run only these blocks")
+    m.add_argument("--json", type=str, help="Also write the results to this JSON file")
+    args = m.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = build_model(args)
+    blocks = [block for block in build_blocks(model, args) if not args.only or block[0] in args.only]
+
+    print('torch {}, {}, {} threads, dim {}, heads {}, dim_head {}, dim_t {}'.format(
+        torch.__version__, args.device, torch.get_num_threads(), args.dim, args.heads, args.dim_head, args.dim_t))
+    print('{:<18} {:<9} {:<28} {:>10} {:>10} {:>10}'.format('block', 'attention', 'input', 'median ms', 'min ms', 'memory MB'))
+    results = []
+    with torch.inference_mode():
+        for name, has_attention, shape, fn in blocks:
+            for path in (args.paths if has_attention else [None]):
+                if path is not None:
+                    set_attention_path(model, path == 'flash')
+                median, fastest, memory = measure(fn, args)
+                results.append({'block': name, 'attention': path, 'input_shape': shape,
+                                'median_ms': median * 1000, 'min_ms': fastest * 1000, 'memory_mb': memory})
+                print('{:<18} {:<9} {:<28} {:>10.2f} {:>10.2f} {:>10.1f}'.format(
+                    name, path or '-', str(shape), median * 1000, fastest * 1000, memory))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'torch': torch.__version__, 'options': vars(args), 'results': results}, f, indent=2)
+        print('Results written to {}'.format(args.json))
+
+
+if __name__ == '__main__':
+    main()
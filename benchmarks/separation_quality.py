@@ -0,0 +1,253 @@
+# coding: utf-8
+"""
+Separation quality of a reference option set against candidate option sets, to check that a faster mode
+doesn't cost quality:
+
+    python -m benchmarks.separation_quality --reference "--use_InstVoc --use_BSRoformer --BigShifts 3" \
+        --candidate "--BigShifts 1" --candidate "--batch_size 4 --single_pass_shifts" [--tracks folder] [--json out.json]
+
+Option strings are inference.py options, candidate options are added after the reference ones.
+A single flag needs the '=' form: --candidate=--vocals_only. Every set needs --use_InstVoc, the vocals above
+the crossover come from InstVoc alone.
+Every track is separated with separate_music_file under every option set. Tracks are subfolders of
+--tracks with one wav per stem (vocals.wav, bass.wav, drums.wav, other.wav, missing stems are fine) and an
+optional mixture.wav, the stems are summed otherwise. Without --tracks synthetic mixtures are generated.
+
+Reported per stem: SDR and SI-SDR against the true stems, the difference to the reference option set and
+the SDR of the candidate output against the reference output (how far the numerics moved). Summary rows
+give wall time, real-time factor (wall seconds per second of audio, as 'rtf' in the --report files of
+inference.py) and mean SDR of every option set, 'pareto' marks sets that no other set beats in both
+wall time and mean SDR difference to the reference.
+SDR is computed here (as in the MDX challenge, over all channels at once), museval is not needed.
+"""
+import argparse
+import collections
+import json
+import os
+import shlex
+import time
+
+import numpy as np
+
+import inference
+
+
+SAMPLE_RATE = 44100
+STEMS = ('vocals', 'bass', 'drums', 'other')
+
+
+def sdr(reference, estimate, eps=1e-8):
+    num = np.sum(np.square(reference))
+    den = np.sum(np.square(reference - estimate))
+    return 10 * np.log10((num + eps) / (den + eps))
+
+
+def si_sdr(reference, estimate, eps=1e-8):
+    reference = reference.reshape(-1).astype(np.float64)
+    estimate = estimate.reshape(-1).astype(np.float64)
+    alpha = np.dot(estimate, reference) / (np.dot(reference, reference) + eps)
+    target = alpha * reference
+    return 10 * np.log10((np.sum(np.square(target)) + eps) / (np.sum(np.square(target - estimate)) + eps))
+
+
+def synthetic_track(seconds, seed):
+    """ Stems of a synthetic song as (2, samples) arrays: harmonic vocal melody with vibrato, bass, drums and chord pads """
+    rng = np.random.default_rng(seed)
+    n = int(seconds * SAMPLE_RATE)
+    t = np.arange(n) / SAMPLE_RATE
+    beat = 60 / rng.uniform(90, 130)
+    stems = {}
+
+    def notes(low, high, length):
+        # note index and fundamental of every sample, notes change every `length` seconds
+        index = (t // length).astype(int)
+        pitches = low * 2 ** (rng.integers(0, 12 * np.log2(high / low), index.max() + 1) / 12)
+        return index, pitches[index]
+
+    def pan(x, position):
+        return np.stack([x * (1 - position), x * (1 + position)])
+
+    index, f0 = notes(180, 500, beat)
+    phase = 2 * np.pi * np.cumsum(f0 * (1 + 0.01 * np.sin(2 * np.pi * 5.5 * t))) / SAMPLE_RATE
+    envelope = np.minimum(1, (t % beat) * 20) * np.exp(-(t % beat))
+    vocals = sum(np.sin(k * phase) / k ** 1.5 for k in range(1, 9)) * envelope
+    stems['vocals'] = pan(vocals, rng.uniform(-0.1, 0.1))
+
+    _, f0 = notes(40, 110, beat * 2)
+    phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+    stems['bass'] = pan(np.sin(phase) + 0.3 * np.sin(2 * phase), 0)
+
+    position = t % beat
+    kick = np.sin(2 * np.pi * (50 + 100 * np.exp(-position * 30)) * position) * np.exp(-position * 12)
+    hat_position = t % (beat / 2)
+    hats = rng.standard_normal(n) * np.exp(-hat_position * 60)
+    hats = np.diff(hats, prepend=0)
+    stems['drums'] = np.stack([kick + 0.3 * hats, kick + 0.25 * np.roll(hats, 17)])
+
+    _, root = notes(130, 260, beat * 4)
+    other = sum(sum(np.sin(2 * np.pi * k * root * ratio * t) / k for k in range(1, 5)) for ratio in (1, 1.26, 1.5))
+    stems['other'] = pan(other * 0.3, rng.uniform(-0.4, 0.4))
+
+    peak = max(np.abs(sum(stems.values())).max(), 1e-8)
+    return {name: (stem * 0.5 / peak).astype(np.float32) for name, stem in stems.items()}
+
+
+def load_tracks(args):
+    """ List of (name, mixture, stems), arrays are (2, samples) at 44100 Hz """
+    tracks = []
+    if args.tracks is None:
+        for k in range(args.synthetic):
+            stems = synthetic_track(args.seconds, k)
+            tracks.append(('synthetic_{}'.format(k), sum(stems.values()), stems))
+        return tracks
+
+    load_options = {'input_gain': 0}
+    for name in sorted(os.listdir(args.tracks)):
+        folder = os.path.join(args.tracks, name)
+        if not os.path.isdir(folder):
+            continue
+        stems = {}
+        for stem in STEMS:
+            path = os.path.join(folder, stem + '.wav')
+            if os.path.isfile(path):
+                stems[stem] = inference.load_input(path, load_options)[0]
+        path = os.path.join(folder, 'mixture.wav')
+        if os.path.isfile(path):
+            mixture = inference.load_input(path, load_options)[0]
+        elif stems:
+            mixture = sum(stems.values())
+        else:
+            continue
+        tracks.append((name, mixture, stems))
+    return tracks
+
+
+def parse_options(arguments):
+    return inference.build_parser().parse_args(['--input_audio', '', '--output_folder', ''] + shlex.split(arguments)).__dict__
+
+
+def separate_all(model, options, tracks, warmup):
+    """ Separated stems of every track as (2, samples) arrays and the wall time of all tracks """
+    inference.options = options
+    if warmup:
+        # models are loaded on first use, that shouldn't count
+        model.separate_music_file(tracks[0][1][:, :SAMPLE_RATE * 5].T, SAMPLE_RATE)
+    outputs = []
+    start = time.time()
+    for name, mixture, _ in tracks:
+        # a fresh stage graph, so nothing is reused from the previous option set
+        model.stages = model.build_stages()
+        result, _ = model.separate_music_file(mixture.T, SAMPLE_RATE)
+        outputs.append({stem: np.asarray(audio).T for stem, audio in result.items()})
+    return outputs, time.time() - start
+
+
+def score(tracks, outputs, reference_outputs):
+    """ Per track and stem metrics of one option set """
+    rows = []
+    for k, (name, mixture, stems) in enumerate(tracks):
+        output = outputs[k]
+        reference_output = reference_outputs[k] if reference_outputs is not None else {}
+        truth = dict(stems)
+        if 'vocals' in truth:
+            truth['instrum'] = mixture - truth['vocals']
+        for stem, estimate in output.items():
+            row = {'track': name, 'stem': stem}
+            if stem in truth:
+                row['sdr'] = float(sdr(truth[stem], estimate))
+                row['si_sdr'] = float(si_sdr(truth[stem], estimate))
+            if stem in reference_output:
+                row['sdr_vs_reference'] = float(sdr(reference_output[stem], estimate))
+            rows.append(row)
+    return rows
+
+
+def mean(rows, key, stem=None):
+    values = [row[key] for row in rows if key in row and (stem is None or row['stem'] == stem)]
+    return float(np.mean(values)) if values else None
+
+
+def fmt(value, width=9):
+    return '{:>{}}'.format('-' if value is None else '{:.2f}'.format(value), width)
+
+
+def main():
+    m = argparse.ArgumentParser(description='SDR and SI-SDR of candidate option sets against a reference option set')
+    m.add_argument("--reference", type=str, help="inference.py options of the reference set, InstVoc must be one of the models", default='--use_InstVoc --use_BSRoformer')
+    m.add_argument("--candidate", type=str, action='append', help="inference.py options of a candidate set, added after the reference options, can be given several times", default=[])
+    m.add_argument("--tracks", type=str, help="Folder of multitrack subfolders, synthetic tracks are used without it")
+    m.add_argument("--synthetic", type=int, help="Number of synthetic tracks", default=2)
+    m.add_argument("--seconds", type=float, help="Length of the synthetic tracks", default=30)
+    m.add_argument("--no_warmup", action='store_true', help="Also time model loading, by default every set separates 5 seconds first")
+    m.add_argument("--json", type=str, help="Also write all metrics to this JSON file")
+    args = m.parse_args()
+
+    tracks = load_tracks(args)
+    if not tracks:
+        print('No tracks found in {}'.format(args.tracks))
+        return
+    sets = collections.OrderedDict([('reference', parse_options(args.reference))])
+    for candidate in args.candidate:
+        sets[candidate] = parse_options(args.reference + ' ' + candidate)
+    for label, options in sets.items():
+        if not options['use_InstVoc']:
+            m.error('{}: --use_InstVoc is needed, the vocals above the crossover come from InstVoc'.format(label))
+
+    models = {}
+    results = collections.OrderedDict()
+    reference_outputs = None
+    for label, options in sets.items():
+        print('Separating {} tracks with {}'.format(len(tracks), label))
+        # options the model is built with, sets that agree on them share the loaded models
+        key = tuple(options[k] for k in inference.MODEL_OPTIONS)
+        inference.options = options
+        if key not in models:
+            models[key] = inference.EnsembleDemucsMDXMusicSeparationModel(options)
+        outputs, seconds = separate_all(models[key], options, tracks, not args.no_warmup)
+        results[label] = {'seconds': seconds, 'rows': score(tracks, outputs, reference_outputs)}
+        if reference_outputs is None:
+            reference_outputs = outputs
+
+    reference_rows = {(row['track'], row['stem']): row for row in results['reference']['rows']}
+    print('\n{:<12} {:<8} {:<32} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'track', 'stem', 'set', 'SDR', 'dSDR', 'SI-SDR', 'dSI-SDR', 'vs ref'))
+    for label, result in results.items():
+        for row in result['rows']:
+            reference_row = reference_rows.get((row['track'], row['stem']), {})
+            if 'sdr' in row and 'sdr' in reference_row:
+                row['sdr_delta'] = row['sdr'] - reference_row['sdr']
+                row['si_sdr_delta'] = row['si_sdr'] - reference_row['si_sdr']
+            print('{:<12} {:<8} {:<32} {}{}{}{}{}'.format(
+                row['track'][:12], row['stem'], label[:32], fmt(row.get('sdr')), fmt(row.get('sdr_delta')),
+                fmt(row.get('si_sdr')), fmt(row.get('si_sdr_delta')), fmt(row.get('sdr_vs_reference'))))
+
+    duration = sum(mixture.shape[-1] for _, mixture, _ in tracks) / SAMPLE_RATE
+    for label, result in results.items():
+        result['rtf'] = result['seconds'] / duration
+        result['mean_sdr'] = mean(result['rows'], 'sdr')
+        result['mean_sdr_delta'] = mean(result['rows'], 'sdr_delta')
+        result['stems'] = {stem: mean(result['rows'], 'sdr', stem) for stem in sorted({row['stem'] for row in result['rows']})}
+    for label, result in results.items():
+        # the SDR difference to the reference is comparable between sets that output different stems
+        quality = result['mean_sdr_delta'] or 0
+        result['pareto'] = not any(
+            other['seconds'] <= result['seconds'] and (other['mean_sdr_delta'] or 0) >= quality
+            and (other['seconds'] < result['seconds'] or (other['mean_sdr_delta'] or 0) > quality)
+            for other in results.values()
+        )
+
+    print('\n{:<32} {:>9} {:>9} {:>9} {:>9} {:>7}  {}'.format('set', 'seconds', 'RTF', 'SDR', 'dSDR', 'pareto', 'SDR per stem'))
+    for label, result in results.items():
+        print('{:<32} {:>9.1f} {:>9.3f} {}{} {:>7}  {}'.format(
+            label[:32], result['seconds'], result['rtf'], fmt(result['mean_sdr']), fmt(result['mean_sdr_delta']),
+            'yes' if result['pareto'] else '', ', '.join('{} {:.2f}'.format(k, v) for k, v in result['stems'].items() if v is not None)))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'tracks': [name for name, _, _ in tracks], 'audio_seconds': duration,
+                       'options': {label: options for label, options in sets.items()}, 'results': results}, f, indent=2)
+        print('Results written to {}'.format(args.json))
+
+
+if __name__ == '__main__':
+    main()
@@ -24,13 +24,22 @@ import onnxruntime as ort
 from time import time
 import librosa
 import hashlib
+import json
+import shutil
 from scipy import signal
 import gc
 import yaml
 from ml_collections import ConfigDict
 import sys
 import math
+import functools
+import contextlib
+import itertools
+import collections
 import pathlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import warnings
 from scipy.signal import resample_poly
 
@@ -82,14 +91,617 @@ def get_model_from_config(model_type, config_path):
     return model, config
 
 
-def demix_new(model, mix, device, config, dim_t=256):
+class ChunkPlan:
+    """
+    Chunk layout of one demix call: start, number of valid samples and window id of every chunk.
+    Plans are cached by get_chunk_plan, so windows (and their normalized versions) are built once
+    per (chunk size, overlap, length, window type, device) and reused by every BigShift and every file.
+    """
+    def __init__(self, length, starts, lengths, window_ids, windows, device='cpu'):
+        """
+            length - number of samples covered by the plan
+            starts, lengths, window_ids - one entry per chunk
+            windows - (number of windows, chunk_size) table indexed by window_ids
+        """
+        self.length = length
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.window_ids = np.asarray(window_ids, dtype=np.int64)
+        self.chunk_size = windows.shape[-1]
+        self.device = device
+        self.windows = windows.to(device)
+        self.starts_t = torch.from_numpy(self.starts).to(device)
+        self.lengths_t = torch.from_numpy(self.lengths).to(device)
+        self.window_ids_t = torch.from_numpy(self.window_ids).to(device)
+        self.offsets_t = torch.arange(self.chunk_size, device=device)
+        self.normalized = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def batches(self, batch_size):
+        batch_size = max(1, int(batch_size))
+        for i in range(0, len(self), batch_size):
+            yield list(range(i, min(i + batch_size, len(self))))
+
+    def extract(self, mix, ids, pad_mode='constant'):
+        """
+        Cut chunks `ids` out of `mix` (channels, length) and pad the short ones up to chunk_size.
+        With pad_mode='reflect', chunks longer than half of chunk_size are reflect padded, the rest with zeros.
+        """
+        parts = []
+        for j in ids:
+            start, length = self.starts[j], self.lengths[j]
+            part = mix[:, start:start + length]
+            if length < self.chunk_size:
+                if pad_mode == 'reflect' and length > self.chunk_size // 2 + 1:
+                    part = nn.functional.pad(input=part, pad=(0, self.chunk_size - length), mode='reflect')
+                else:
+                    part = nn.functional.pad(input=part, pad=(0, self.chunk_size - length, 0, 0), mode='constant', value=0)
+            parts.append(part)
+        return torch.stack(parts, dim=0)
+
+    def normalized_windows(self):
+        """
+        Window of every chunk divided by the sum of all windows overlapping it (analytic normalization).
+        Chunks with the same neighbourhood share one row, so the table stays a few rows long.
+        Returns (table, row of every chunk).
+        """
+        if self.normalized is None:
+            chunk_size = self.chunk_size
+            windows = self.windows.cpu()
+            rows = []
+            row_ids = np.zeros(len(self), dtype=np.int64)
+            keys = {}
+            for j in range(len(self)):
+                start = self.starts[j]
+                first = np.searchsorted(self.starts, start - chunk_size + 1)
+                last = np.searchsorted(self.starts, start + chunk_size)
+                neighbours = range(first, last)
+                key = tuple((self.starts[k] - start, self.lengths[k], self.window_ids[k]) for k in neighbours)
+                if key not in keys:
+                    divisor = torch.zeros(3 * chunk_size, dtype=torch.float32)
+                    for k in neighbours:
+                        offset = chunk_size + self.starts[k] - start
+                        divisor[offset:offset + self.lengths[k]] += windows[self.window_ids[k], :self.lengths[k]]
+                    divisor = divisor[chunk_size:2 * chunk_size]
+                    own = windows[self.window_ids[j]]
+                    keys[key] = len(rows)
+                    rows.append(torch.where(divisor > 0, own / divisor, torch.zeros_like(divisor)))
+                row_ids[j] = keys[key]
+            self.normalized = (torch.stack(rows).to(self.device), torch.from_numpy(row_ids).to(self.device))
+        return self.normalized
+
+
+@functools.lru_cache(maxsize=16)
+def get_chunk_plan(length, chunk_size, step, window='ones', device='cpu'):
+    """
+    Build (or take from cache) the chunk plan for a signal of `length` samples.
+        window - 'fade': short linear fades, no fade-in on the first chunk and no fade-out on the last one (demix_new)
+                 'hanning': Hanning window over the valid part of every chunk (demix)
+                 'ones': plain averaging (demix_vitlarge)
+    """
+    starts = np.arange(0, length, step, dtype=np.int64)
+    lengths = np.minimum(chunk_size, length - starts)
+    window_ids = np.zeros(len(starts), dtype=np.int64)
+
+    if window == 'fade':
+        # This trick repairs click problems on the edges of segment
+        fade_size = chunk_size // 100
+        fadein = torch.linspace(0, 1, fade_size)
+        fadeout = torch.linspace(1, 0, fade_size)
+        window_middle = torch.ones(chunk_size)
+        window_start = torch.ones(chunk_size)
+        window_finish = torch.ones(chunk_size)
+        window_start[-fade_size:] *= fadeout # First audio chunk, no fadein
+        window_finish[:fade_size] *= fadein # Last audio chunk, no fadeout
+        window_middle[-fade_size:] *= fadeout
+        window_middle[:fade_size] *= fadein
+        windows = torch.stack([window_middle, window_start, window_finish])
+        window_ids[starts + step >= length] = 2
+        window_ids[0] = 1
+    elif window == 'hanning':
+        # Hanning windows only differ for the shorter chunks at the end
+        unique_lengths = sorted(set(lengths.tolist()), reverse=True)
+        windows = torch.zeros((len(unique_lengths), chunk_size), dtype=torch.float32)
+        for k, chunk_length in enumerate(unique_lengths):
+            windows[k, :chunk_length] = torch.from_numpy(np.hanning(chunk_length).astype(np.float32))
+            window_ids[lengths == chunk_length] = k
+    else:
+        windows = torch.ones((1, chunk_size), dtype=torch.float32)
+
+    return ChunkPlan(length, starts, lengths, window_ids, windows, device=device)
+
+
+class OverlapAdd:
+    """
+    Overlap-add accumulator shared by all demix functions.
+    A whole batch of windowed chunk outputs is folded into the output with one scatter-add.
+
+    Normalization modes:
+        'counter' - window sums are accumulated in a second buffer as large as the output
+        'analytic' - window sums are taken from the chunk plan, so every chunk is added
+                     already normalized and no second full length buffer is kept
+    """
+    def __init__(self, shape, plan, normalize='counter', output_length=None, offset=0):
+        """
+            shape - leading dimensions of the output, e.g. (instruments, channels)
+            plan - ChunkPlan of the chunks that will be added, the buffers live on its device
+            output_length, offset - fold chunks of shifted copies straight into one unshifted output of
+                     `output_length` samples: plan position p added with shift s lands on (p - offset - s) % output_length,
+                     positions outside of [offset, offset + output_length) are dropped. Needs 'analytic'
+        """
+        if normalize not in ('counter', 'analytic'):
+            raise ValueError('Unknown overlap normalization: {}'.format(normalize))
+        if output_length is not None and normalize != 'analytic':
+            raise ValueError('Unshifted accumulation needs analytic overlap normalization')
+        self.shape = tuple(shape)
+        self.plan = plan
+        self.unshift = output_length is not None
+        self.length = output_length if self.unshift else plan.length
+        self.offset = offset
+        self.device = plan.device
+        self.normalize = normalize
+        # One extra sample at the end collects the padded tails of chunks, it's dropped at the end
+        self.result = torch.zeros(self.shape + (self.length + 1,), dtype=torch.float32, device=self.device)
+        self.counter = None
+        if normalize == 'counter':
+            self.counter = torch.zeros(self.shape + (self.length + 1,), dtype=torch.float32, device=self.device)
+
+    def add(self, x, ids, shifts=None):
+        """
+            x - batch of chunk outputs (batch, *shape, chunk_size)
+            ids - indices of these chunks in the plan
+            shifts - BigShifts offset of every chunk, only when accumulating into an unshifted output
+        """
+        plan = self.plan
+        batch, chunk_size = x.shape[0], x.shape[-1]
+        ids = torch.as_tensor(ids, dtype=torch.int64, device=self.device)
+        valid = plan.offsets_t < plan.lengths_t[ids].view(-1, 1)
+        position = plan.starts_t[ids].view(-1, 1) + plan.offsets_t
+        if self.unshift:
+            position = position - self.offset
+            valid = valid & (position >= 0) & (position < self.length)
+            shifts = torch.as_tensor(shifts, dtype=torch.int64, device=self.device).view(-1, 1)
+            position = torch.remainder(position - shifts, self.length)
+        index = torch.where(valid, position, self.length).view(-1)
+
+        if self.normalize == 'analytic':
+            table, rows = plan.normalized_windows()
+            windows = table[rows[ids]]
+        else:
+            windows = plan.windows[plan.window_ids_t[ids]]
+        windows = windows * valid
+        x = x.to(self.device, torch.float32).reshape((batch, ) + self.shape + (chunk_size, ))
+        x = x * windows.view((batch, ) + (1, ) * len(self.shape) + (chunk_size, ))
+        x = x.movedim(0, -2).reshape(self.shape + (-1, ))
+        self.result.index_add_(-1, index, x)
+        if self.counter is not None:
+            self.counter.index_add_(-1, index, windows.view(-1).expand(self.shape + (-1, )))
+
+    def finalize(self):
+        if self.counter is None:
+            return self.result[..., :self.length]
+        return self.result[..., :self.length] / self.counter[..., :self.length]
+
+
+def resident_memory():
+    """
+    Anonymous resident memory of the process in bytes (resident minus file-backed and shared pages, RssAnon),
+    None where /proc isn't there. Page cache of memory-mapped files such as the spill store is left out,
+    the kernel can reclaim it.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            fields = f.read().split()
+        return (int(fields[1]) - int(fields[2])) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError, IndexError):
+        return None
+
+
+def megabytes(n):
+    return None if n is None else round(n / 1024 ** 2, 1)
+
+
+class MemoryMonitor:
+    """
+    Peak memory of the whole process over open intervals, which may nest and come from several threads.
+    While an interval is open a thread samples the anonymous resident memory every `interval` seconds,
+    CUDA peaks come from the allocator statistics of torch.
+    With a ceiling set, check() raises MemoryError once the process went above it, so a stage fails
+    with a clear error instead of the process getting killed by the OOM killer.
+    Nothing is measured until configure() enables it for a report or a ceiling, open() returns None then.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.intervals = []
+        self.sampler = None
+        self.rss_ceiling = 0
+        self.cuda_ceiling = 0
+        self.exceeded = None
+        self.enabled = False
+
+    def configure(self, options):
+        """
+        Ceilings from the 'memory_ceiling' and 'cuda_memory_ceiling' options in GB, 0 - none.
+        Measuring is enabled by a ceiling or the 'report' option
+        """
+        with self.lock:
+            self.rss_ceiling = int(float(options.get('memory_ceiling', 0) or 0) * 1024 ** 3)
+            self.cuda_ceiling = int(float(options.get('cuda_memory_ceiling', 0) or 0) * 1024 ** 3)
+            self.exceeded = None
+            self.enabled = bool(options.get('report', False) or self.rss_ceiling or self.cuda_ceiling)
+
+    def fold_cuda(self):
+        # the peak since the last reset belongs to every interval open now, called with the lock held
+        if not torch.cuda.is_available():
+            return
+        peak = torch.cuda.max_memory_allocated()
+        for interval in self.intervals:
+            interval['cuda'] = max(interval['cuda'], peak)
+        if self.cuda_ceiling and peak > self.cuda_ceiling and self.exceeded is None:
+            self.exceeded = 'CUDA memory {:.2f} GB, ceiling {:.2f} GB'.format(peak / 1024 ** 3, self.cuda_ceiling / 1024 ** 3)
+        torch.cuda.reset_peak_memory_stats()
+
+    def sample(self):
+        rss = resident_memory()
+        if rss is None:
+            return
+        with self.lock:
+            for interval in self.intervals:
+                interval['rss'] = max(interval['rss'], rss)
+            if self.rss_ceiling and rss > self.rss_ceiling and self.exceeded is None:
+                self.exceeded = 'anonymous resident memory {:.2f} GB, ceiling {:.2f} GB'.format(rss / 1024 ** 3, self.rss_ceiling / 1024 ** 3)
+
+    def run(self):
+        wait = threading.Event()
+        while True:
+            wait.wait(self.interval)
+            with self.lock:
+                if not self.intervals:
+                    self.sampler = None
+                    return
+            self.sample()
+
+    def open(self):
+        if not self.enabled:
+            return None
+        rss = resident_memory()
+        with self.lock:
+            self.fold_cuda()
+            interval = {'rss': rss or 0, 'cuda': torch.cuda.memory_allocated() if torch.cuda.is_available() else 0}
+            self.intervals.append(interval)
+            if self.sampler is None and rss is not None:
+                self.sampler = threading.Thread(target=self.run, daemon=True)
+                self.sampler.start()
+        return interval
+
+    def close(self, interval):
+        """ Returns the peak_rss_mb and peak_cuda_mb fields of a timing row """
+        if interval is None:
+            return {}
+        self.sample()
+        with self.lock:
+            self.fold_cuda()
+            # by identity, intervals with the same numbers are equal dicts
+            self.intervals = [i for i in self.intervals if i is not interval]
+        return {'peak_rss_mb': megabytes(interval['rss']) if interval['rss'] else None,
+                'peak_cuda_mb': megabytes(interval['cuda']) if torch.cuda.is_available() else None}
+
+    def check(self, stage):
+        if not self.enabled:
+            return
+        self.sample()
+        with self.lock:
+            self.fold_cuda()
+            exceeded = self.exceeded
+        if exceeded is not None:
+            raise MemoryError('Memory ceiling exceeded during {}: {}. Lower batch_size or use '
+                              '--stream_seconds'.format(stage, exceeded))
+
+
+memory_monitor = MemoryMonitor()
+
+
+class Progress:
+    """
+    Progress of separate_music_file, reported to callback(info) at every stage start and after every batch of chunks.
+    info keys: file, files, model, stage, stages, pass, passes, shift, shifts, chunk, chunks,
+        progress - 0..1 over the whole track
+        chunks_per_sec - throughput of the current stage
+        stage_eta, eta - seconds left in the stage and in the track, None until something was measured
+    An exception raised by the callback aborts the separation.
+    Wall time and chunk count of every model stage, shift and timed() block are collected in `timings`,
+    with their peak memory when a MemoryMonitor is given, its ceiling is checked after every batch of chunks.
+    """
+    def __init__(self, callback=None, current_file_number=0, total_files=0, stages=1, monitor=None):
+        self.callback = callback
+        self.monitor = monitor
+        self.timings = []
+        self.shift_start = None
+        self.stage_memory = self.shift_memory = None
+        self.file = current_file_number
+        self.files = total_files
+        self.stages = stages
+        self.stage = -1
+        self.model = None
+        self.start = time()
+        self.start_stage(None)
+
+    def start_stage(self, model):
+        self.stage += 1
+        self.model = model
+        self.pass_, self.passes = 0, 1
+        self.shift, self.shifts = 0, 1
+        self.chunk, self.chunks = 0, 0
+        self.stage_start = time()
+        self.stage_chunks = 0
+        self.shift_start = None
+        if model is not None:
+            self.stage_memory = self.open_memory()
+            self.report()
+
+    def end_stage(self):
+        self.end_shift()
+        row = {'name': self.model, 'seconds': time() - self.stage_start, 'chunks': self.stage_chunks}
+        self.stage_memory = self.close_memory(self.stage_memory, row)
+        self.timings.append(row)
+
+    def open_memory(self):
+        if self.monitor is None:
+            return None
+        self.monitor.check(self.model)
+        return self.monitor.open()
+
+    def close_memory(self, interval, row):
+        """ Adds the peak memory of `interval` to a timing row, returns None for the closed interval """
+        if interval is not None:
+            row.update(self.monitor.close(interval))
+            self.monitor.check(row['name'])
+        return None
+
+    def release(self):
+        """ Closes the memory intervals of stages that ended with an error """
+        for interval in (self.shift_memory, self.stage_memory):
+            if interval is not None:
+                self.monitor.close(interval)
+        self.stage_memory = self.shift_memory = None
+
+    def start_pass(self, n, passes):
+        """ A model run several times in one stage, e.g. once per polarity """
+        self.end_shift()
+        self.pass_, self.passes = n, passes
+        self.shift, self.shifts = 0, 1
+        self.chunk, self.chunks = 0, 0
+
+    def start_shift(self, shift, shifts):
+        self.end_shift()
+        self.shift, self.shifts = shift, shifts
+        self.chunk, self.chunks = 0, 0
+        self.shift_start = time()
+        self.shift_memory = self.open_memory()
+
+    def end_shift(self):
+        if self.shift_start is None:
+            return
+        name = '{} shift {}'.format(self.model, self.shift)
+        if self.passes > 1:
+            name = '{} pass {} shift {}'.format(self.model, self.pass_, self.shift)
+        # 'model' marks the row as a part of that model's row
+        row = {'name': name, 'seconds': time() - self.shift_start, 'chunks': self.chunk, 'model': self.model}
+        self.shift_start = None
+        self.shift_memory = self.close_memory(self.shift_memory, row)
+        self.timings.append(row)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time()
+        interval = self.monitor.open() if self.monitor is not None else None
+        try:
+            yield
+        finally:
+            row = {'name': name, 'seconds': time() - start, 'chunks': None}
+            if interval is not None:
+                row.update(self.monitor.close(interval))
+            self.timings.append(row)
+        if self.monitor is not None:
+            self.monitor.check(name)
+
+    def start_chunks(self, chunks):
+        self.chunk, self.chunks = 0, chunks
+
+    def advance(self, n=1):
+        self.chunk += n
+        self.stage_chunks += n
+        if self.monitor is not None:
+            self.monitor.check(self.model)
+        self.report()
+
+    def finish(self):
+        self.stage, self.model = self.stages, None
+        self.pass_, self.passes = 0, 1
+        self.shift, self.shifts = 0, 1
+        self.chunk = self.chunks = self.stage_chunks = 1
+        self.report()
+
+    def report(self):
+        if self.callback is None:
+            return
+        now = time()
+        chunk_fraction = self.chunk / self.chunks if self.chunks else 0.0
+        stage_fraction = (self.pass_ + (self.shift + chunk_fraction) / self.shifts) / self.passes
+        fraction = min(1.0, (max(self.stage - 1, 0) + stage_fraction) / max(self.stages, 1))
+        elapsed = now - self.stage_start
+        rate = self.stage_chunks / elapsed if self.stage_chunks and elapsed > 0 else None
+        stage_eta = None
+        if rate and self.chunks:
+            stage_left = (self.passes * self.shifts * self.chunks) - self.stage_chunks
+            stage_eta = max(stage_left, 0) / rate
+        eta = (now - self.start) * (1 - fraction) / fraction if fraction > 0 else None
+        self.callback({
+            'file': self.file, 'files': self.files, 'model': self.model, 'stage': self.stage, 'stages': self.stages,
+            'pass': self.pass_, 'passes': self.passes, 'shift': self.shift, 'shifts': self.shifts,
+            'chunk': self.chunk, 'chunks': self.chunks, 'progress': fraction,
+            'chunks_per_sec': rate, 'stage_eta': stage_eta, 'eta': eta,
+        })
+
+
+_progress = threading.local()
+
+
+def current_progress():
+    """ Progress of the separation running in this thread, one that reports nowhere outside of separate_music_file """
+    tracker = getattr(_progress, 'tracker', None)
+    return tracker if tracker is not None else Progress()
+
+
+class Profiler:
+    """
+    Op-level profile of one separate_music_file call. Torch ops are recorded with torch.profiler and every
+    model call is marked as '<model> forward' or '<model> onnx run'. ONNX Runtime sessions record their own
+    nodes into trace files in `folder`, see ModelRegistry.start_profiling.
+    """
+    def __init__(self, device):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        self.cuda = torch.cuda.is_available() and str(device) != 'cpu'
+        if self.cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profile = torch.profiler.profile(activities=activities)
+        self.folder = tempfile.mkdtemp(prefix='onnx_profile_')
+        self.regions = []
+        # model name -> ONNX Runtime trace file
+        self.onnx_traces = {}
+
+    def __enter__(self):
+        self.profile.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.__exit__(*exc)
+
+    def region(self, kind):
+        name = '{} {}'.format(current_progress().model, kind)
+        if name not in self.regions:
+            self.regions.append(name)
+        return torch.profiler.record_function(name)
+
+    def operator_table(self, events, region, top):
+        """ Operators called inside every `region` block, by self time """
+        roots = [e for e in events if e.name == region]
+        ops = collections.OrderedDict()
+        stack = list(roots)
+        while stack:
+            event = stack.pop()
+            for child in event.cpu_children:
+                op = ops.setdefault(child.name, [0, 0.0, 0.0])
+                op[0] += 1
+                op[1] += child.self_cpu_time_total
+                op[2] += getattr(child, 'self_device_time_total', getattr(child, 'self_cuda_time_total', 0))
+                stack.append(child)
+        total = sum(e.cpu_time_total for e in roots)
+        lines = ['{}: {} calls, {:.1f} ms'.format(region, len(roots), total / 1000),
+                 '    {:<48} {:>8} {:>10} {:>6}'.format('operator', 'calls', 'self ms', '%') + ('  device ms' if self.cuda else '')]
+        for name, (calls, cpu, device) in sorted(ops.items(), key=lambda op: -(op[1][1] + op[1][2]))[:top]:
+            line = '    {:<48} {:>8} {:>10.1f} {:>6.1f}'.format(name[:48], calls, cpu / 1000, 100 * cpu / total if total else 0)
+            lines.append(line + ('  {:>9.1f}'.format(device / 1000) if self.cuda else ''))
+        return lines
+
+    def export(self, prefix, top=20):
+        """
+        Writes <prefix>_trace.json (Chrome trace, opens in Perfetto or chrome://tracing), the ONNX Runtime
+        trace of every ONNX model as <prefix>_<model>_onnx_trace.json and the `top` operators of every model
+        to <prefix>_profile.txt. Returns the written paths
+        """
+        paths = [prefix + '_trace.json']
+        self.profile.export_chrome_trace(paths[0])
+        lines = []
+        events = self.profile.events()
+        for region in self.regions:
+            lines += self.operator_table(events, region, top) + ['']
+        for model, trace in self.onnx_traces.items():
+            paths.append('{}_{}_onnx_trace.json'.format(prefix, model))
+            shutil.move(trace, paths[-1])
+            lines += onnx_operator_table(paths[-1], model, top) + ['']
+        self.close()
+        paths.append(prefix + '_profile.txt')
+        with open(paths[-1], 'w') as f:
+            f.write('\n'.join(lines))
+        return paths
+
+    def close(self):
+        """ Removes the folder of the ONNX Runtime traces, for a profile that won't be exported """
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def onnx_operator_table(trace, model, top=20):
+    """ ONNX Runtime node kernels of a session trace by op type and time """
+    with open(trace) as f:
+        events = json.load(f)
+    ops = collections.OrderedDict()
+    for event in events:
+        if event.get('cat') == 'Node' and event.get('name', '').endswith('_kernel_time'):
+            op = ops.setdefault(event.get('args', {}).get('op_name', event['name']), [0, 0])
+            op[0] += 1
+            op[1] += event.get('dur', 0)
+    total = sum(op[1] for op in ops.values())
+    lines = ['{} onnx nodes: {:.1f} ms'.format(model, total / 1000),
+             '    {:<48} {:>8} {:>10} {:>6}'.format('operator', 'calls', 'ms', '%')]
+    for name, (calls, duration) in sorted(ops.items(), key=lambda op: -op[1][1])[:top]:
+        lines.append('    {:<48} {:>8} {:>10.1f} {:>6.1f}'.format(name[:48], calls, duration / 1000, 100 * duration / total if total else 0))
+    return lines
+
+
+def model_call(kind='forward'):
+    """ Marks a model call in the profile of the separation running in this thread, does nothing when not profiling """
+    profiler = getattr(_progress, 'profiler', None)
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.region(kind)
+
+
+def demix_single_pass(mix, shifts, plan, forward, shape, offset=0, prepare=None, batch_size=1, pad_mode='constant'):
+    """
+    All BigShifts in one pass: chunks of every shifted copy go through `forward` in shared batches and
+    are folded, already unshifted, into one accumulator. Every chunk is normalized analytically, so the
+    result equals the mean of the separately normalized shifts.
+        mix - (channels, samples) tensor
+        plan - ChunkPlan of one prepared shifted copy
+        forward - batch of chunks (batch, channels, chunk_size) -> (batch, *shape, chunk_size)
+        prepare - turns a shifted copy into the padded signal the plan was built for, `offset` is its left padding
+    """
+    accumulator = OverlapAdd(shape, plan, normalize='analytic', output_length=mix.shape[-1], offset=offset)
+    batch_data = []
+    batch_ids = []
+    batch_shifts = []
+    progress = tqdm(total=len(shifts) * len(plan), position=0)
+    tracker = current_progress()
+    tracker.start_chunks(len(shifts) * len(plan))
+    for n, shift in enumerate(shifts):
+        shifted_mix = torch.cat((mix[:, -shift:], mix[:, :-shift]), dim=-1)
+        if prepare is not None:
+            shifted_mix = prepare(shifted_mix)
+        for j in range(len(plan)):
+            batch_data.append(plan.extract(shifted_mix, [j], pad_mode=pad_mode)[0])
+            batch_ids.append(j)
+            batch_shifts.append(shift)
+            if len(batch_data) >= batch_size or (n == len(shifts) - 1 and j == len(plan) - 1):
+                accumulator.add(forward(torch.stack(batch_data, dim=0)), batch_ids, batch_shifts)
+                progress.update(len(batch_data))
+                tracker.advance(len(batch_data))
+                batch_data = []
+                batch_ids = []
+                batch_shifts = []
+    progress.close()
+    return accumulator.finalize() / len(shifts)
+
+
+def demix_new(model, mix, device, config, dim_t=256, batch_size=1, normalize='counter'):
     mix = torch.tensor(mix)
     #N = options["overlap_BSRoformer"]
     N = 2 # overlap 50%
-    batch_size = 1
     mdx_window_size = dim_t
     C = config.audio.hop_length * (mdx_window_size - 1)
-    fade_size = C // 100
     step = int(C // N)
     border = C - step
     length_init = mix.shape[-1]
@@ -98,22 +710,10 @@ def demix_new(model, mix, device, config, dim_t=256):
     # Do pad from the beginning and end to account floating window results better
     if length_init > 2 * border and (border > 0):
         mix = nn.functional.pad(mix, (border, border), mode='reflect')
-        
-    
-    # Prepare windows arrays (do 1 time for speed up). This trick repairs click problems on the edges of segment
-    window_size = C
-    fadein = torch.linspace(0, 1, fade_size)
-    fadeout = torch.linspace(1, 0, fade_size)
-    window_start = torch.ones(window_size)
-    window_middle = torch.ones(window_size)
-    window_finish = torch.ones(window_size)
-    window_start[-fade_size:] *= fadeout # First audio chunk, no fadein
-    window_finish[:fade_size] *= fadein # Last audio chunk, no fadeout
-    window_middle[-fade_size:] *= fadeout
-    window_middle[:fade_size] *= fadein
-
-
 
+    # Windows and chunk positions are cached between calls, each chunk keeps its own window
+    # so a batch may mix start, middle and finish chunks
+    plan = get_chunk_plan(mix.shape[1], C, step, 'fade')
 
     with torch.cuda.amp.autocast():
         with torch.inference_mode():
@@ -122,43 +722,17 @@ def demix_new(model, mix, device, config, dim_t=256):
             else:
                 req_shape = (len(config.training.instruments),) + tuple(mix.shape)
 
-            result = torch.zeros(req_shape, dtype=torch.float32)
-            counter = torch.zeros(req_shape, dtype=torch.float32)
-            i = 0
-            batch_data = []
-            batch_locations = []
-            while i < mix.shape[1]:
-                # print(i, i + C, mix.shape[1])
-                part = mix[:, i:i + C].to(device)
-                length = part.shape[-1]
-                if length < C:
-                    if length > C // 2 + 1:
-                        part = nn.functional.pad(input=part, pad=(0, C - length), mode='reflect')
-                    else:
-                        part = nn.functional.pad(input=part, pad=(0, C - length, 0, 0), mode='constant', value=0)
-                batch_data.append(part)
-                batch_locations.append((i, length))
-                i += step
-
-                if len(batch_data) >= batch_size or (i >= mix.shape[1]):
-                    arr = torch.stack(batch_data, dim=0)
+            accumulator = OverlapAdd(req_shape[:-1], plan, normalize=normalize)
+            tracker = current_progress()
+            tracker.start_chunks(len(plan))
+            for ids in plan.batches(batch_size):
+                arr = plan.extract(mix, ids, pad_mode='reflect').to(device)
+                with model_call():
                     x = model(arr)
+                accumulator.add(x, ids)
+                tracker.advance(len(ids))
 
-                    window = window_middle
-                    if i - step == 0:  # First audio chunk, no fadein
-                        window = window_start
-                    elif i >= mix.shape[1]:  # Last audio chunk, no fadeout
-                        window = window_finish
-
-                    for j in range(len(batch_locations)):
-                        start, l = batch_locations[j]
-                        result[..., start:start+l] += x[j][..., :l].cpu() * window[..., :l]
-                        counter[..., start:start+l] += window[..., :l]
-
-                    batch_data = []
-                    batch_locations = []
-
-            estimated_sources = result / counter
+            estimated_sources = accumulator.finalize()
             estimated_sources = estimated_sources.cpu().numpy()
             np.nan_to_num(estimated_sources, copy=False, nan=0.0)
 
@@ -172,7 +746,14 @@ def demix_new(model, mix, device, config, dim_t=256):
         return {k: v for k, v in zip([config.training.target_instrument], estimated_sources)}
 
 
-def demix_new_wrapper(mix, device, model, config, dim_t=256):
+def add_unshifted(acc, sources, shift):
+    """ acc += sources rolled back by shift samples, without a rolled copy """
+    n = sources.shape[-1] - shift
+    acc[..., :n] += sources[..., shift:]
+    acc[..., n:] += sources[..., :shift]
+
+
+def demix_new_wrapper(mix, device, model, config, dim_t=256, batch_size=1, normalize='counter', single_pass=False):
     if options["BigShifts"] <= 0:
         bigshifts = 1
     else:
@@ -181,22 +762,52 @@ def demix_new_wrapper(mix, device, model, config, dim_t=256):
     shift_in_samples = mix.shape[1] // bigshifts
     shifts = [x * shift_in_samples for x in range(bigshifts)]
 
-    results = []
+    if single_pass:
+        # Same chunking as demix_new, but only the vocals are kept
+        C = config.audio.hop_length * (dim_t - 1)
+        step = int(C // 2)
+        border = C - step
+        padded = mix.shape[-1] > 2 * border and (border > 0)
+        if config.training.target_instrument is not None:
+            instruments = [config.training.target_instrument]
+        else:
+            instruments = list(config.training.instruments)
+        vocals_index = [key.lower() for key in instruments].index("vocals")
+        plan = get_chunk_plan(mix.shape[-1] + 2 * border * padded, C, step, 'fade')
+
+        def prepare(shifted_mix):
+            return nn.functional.pad(shifted_mix, (border, border), mode='reflect') if padded else shifted_mix
+
+        def forward(arr):
+            with model_call():
+                x = model(arr.to(device))
+            return x.reshape((x.shape[0], len(instruments), -1, x.shape[-1]))[:, vocals_index]
+
+        with torch.cuda.amp.autocast():
+            with torch.inference_mode():
+                vocals = demix_single_pass(torch.tensor(mix), shifts, plan, forward, (mix.shape[0], ),
+                                           offset=border * padded, prepare=prepare, batch_size=batch_size, pad_mode='reflect')
+        return vocals.numpy()
 
-    for shift in tqdm(shifts, position=0):
+    # running sum of the unshifted results, divided once at the end
+    acc = None
+
+    for k, shift in enumerate(tqdm(shifts, position=0)):
+        current_progress().start_shift(k, len(shifts))
         shifted_mix = np.concatenate((mix[:, -shift:], mix[:, :-shift]), axis=-1)
-        sources = demix_new(model, shifted_mix, device, config, dim_t=dim_t)
+        sources = demix_new(model, shifted_mix, device, config, dim_t=dim_t, batch_size=batch_size, normalize=normalize)
         vocals = next(sources[key] for key in sources.keys() if key.lower() == "vocals")
-        unshifted_vocals = np.concatenate((vocals[..., shift:], vocals[..., :shift]), axis=-1)  
         vocals *= 1 # 1.0005168 CHECK NEEDED! volume compensation
-        
-        results.append(unshifted_vocals)
+        if acc is None:
+            acc = np.zeros(vocals.shape, dtype=np.float32)
+        add_unshifted(acc, vocals, shift)
+        del sources, vocals
 
-    vocals = np.mean(results, axis=0)
+    acc /= len(shifts)
     
-    return vocals
+    return acc
 
-def demix_vitlarge(model, mix, device):
+def demix_vitlarge(model, mix, device, batch_size=1, normalize='counter'):
     C = model.config.audio.hop_length * (2 * model.config.inference.dim_t - 1)
     N = 2
     step = C // N
@@ -209,20 +820,17 @@ def demix_vitlarge(model, mix, device):
                 req_shape = (len(model.config.training.instruments),) + tuple(mix.shape)
 
             mix = mix.to(device)
-            result = torch.zeros(req_shape, dtype=torch.float32).to(device)
-            counter = torch.zeros(req_shape, dtype=torch.float32).to(device)
-            i = 0
-
-            while i < mix.shape[1]:
-                part = mix[:, i:i + C]
-                length = part.shape[-1]
-                if length < C:
-                    part = nn.functional.pad(input=part, pad=(0, C - length, 0, 0), mode='constant', value=0)
-                x = model(part.unsqueeze(0))[0]
-                result[..., i:i+length] += x[..., :length]
-                counter[..., i:i+length] += 1.
-                i += step
-            estimated_sources = result / counter
+            plan = get_chunk_plan(mix.shape[1], C, step, 'ones', device=str(mix.device))
+            accumulator = OverlapAdd(req_shape[:-1], plan, normalize=normalize)
+            tracker = current_progress()
+            tracker.start_chunks(len(plan))
+
+            for ids in plan.batches(batch_size):
+                with model_call():
+                    x = model(plan.extract(mix, ids))
+                accumulator.add(x, ids)
+                tracker.advance(len(ids))
+            estimated_sources = accumulator.finalize()
 
     if model.config.training.target_instrument is None:
         return {k: v for k, v in zip(model.config.training.instruments, estimated_sources.cpu().numpy())}
@@ -230,7 +838,7 @@ def demix_vitlarge(model, mix, device):
         return {k: v for k, v in zip([model.config.training.target_instrument], estimated_sources.cpu().numpy())}
 
 
-def demix_full_vitlarge(mix, device, model):
+def demix_full_vitlarge(mix, device, model, batch_size=1, normalize='counter', single_pass=False):
     if options["BigShifts"] <= 0:
         bigshifts = 1
     else:
@@ -238,109 +846,180 @@ def demix_full_vitlarge(mix, device, model):
     shift_in_samples = mix.shape[1] // bigshifts
     shifts = [x * shift_in_samples for x in range(bigshifts)]
 
-    results1 = []
-    results2 = []
     mix = torch.from_numpy(mix).type('torch.FloatTensor').to(device)
-    for shift in tqdm(shifts, position=0):
-        shifted_mix = torch.cat((mix[:, -shift:], mix[:, :-shift]), dim=-1)
-        sources = demix_vitlarge(model, shifted_mix, device)
-        sources1 = sources["vocals"]
-        sources2 = sources["other"]
-        restored_sources1 = np.concatenate((sources1[..., shift:], sources1[..., :shift]), axis=-1)
-        restored_sources2 = np.concatenate((sources2[..., shift:], sources2[..., :shift]), axis=-1)
-        results1.append(restored_sources1)
-        results2.append(restored_sources2)
 
+    if single_pass:
+        C = model.config.audio.hop_length * (2 * model.config.inference.dim_t - 1)
+        if model.config.training.target_instrument is not None:
+            instruments = [model.config.training.target_instrument]
+        else:
+            instruments = list(model.config.training.instruments)
+        plan = get_chunk_plan(mix.shape[1], C, C // 2, 'ones', device=str(mix.device))
+
+        def forward(arr):
+            with model_call():
+                x = model(arr)
+            return x.reshape((x.shape[0], len(instruments), -1, x.shape[-1]))
+
+        with torch.cuda.amp.autocast():
+            with torch.no_grad():
+                sources = demix_single_pass(mix, shifts, plan, forward, (len(instruments), mix.shape[0]), batch_size=batch_size)
+        sources = sources.cpu().numpy()
+        return sources[instruments.index("vocals")], sources[instruments.index("other")]
+
+    sources1 = np.zeros(tuple(mix.shape), dtype=np.float32)
+    sources2 = np.zeros(tuple(mix.shape), dtype=np.float32)
+    for k, shift in enumerate(tqdm(shifts, position=0)):
+        current_progress().start_shift(k, len(shifts))
+        shifted_mix = torch.cat((mix[:, -shift:], mix[:, :-shift]), dim=-1)
+        sources = demix_vitlarge(model, shifted_mix, device, batch_size=batch_size, normalize=normalize)
+        add_unshifted(sources1, sources["vocals"], shift)
+        add_unshifted(sources2, sources["other"], shift)
+        del sources
 
-    sources1 = np.mean(results1, axis=0)
-    sources2 = np.mean(results2, axis=0)
+    sources1 /= len(shifts)
+    sources2 /= len(shifts)
 
     return sources1, sources2
 
 
-def demix_wrapper(mix, device, models, infer_session, overlap=0.2, bigshifts=1, vc=1.0):
+def demix_wrapper(mix, device, models, infer_session, overlap=0.2, bigshifts=1, vc=1.0, normalize='counter', batch_size=1, single_pass=False, polarity=False):
     if bigshifts <= 0:
         bigshifts = 1
     shift_in_samples = mix.shape[1] // bigshifts
     shifts = [x * shift_in_samples for x in range(bigshifts)]
-    results = []
+
+    if single_pass:
+        chunk_size, trim, pad = mdx_chunking(models[0], mix.shape[-1])
+        step = int((1 - overlap) * chunk_size)
+        mdx_batch_size, fixed_batch = onnx_batch_size(infer_session, batch_size)
+        plan = get_chunk_plan(trim + mix.shape[-1] + pad, chunk_size, step, 'hanning' if overlap != 0 else 'ones')
+
+        def prepare(shifted_mix):
+            return nn.functional.pad(shifted_mix, (trim, pad))
+
+        def forward(mix_wave):
+            return onnx_forward(models[0], infer_session, mix_wave.to(device), mdx_batch_size if fixed_batch else 0, polarity=polarity)
+
+        with torch.no_grad():
+            sources = demix_single_pass(torch.from_numpy(mix).float(), shifts, plan, forward, (mix.shape[0], ),
+                                        offset=trim, prepare=prepare, batch_size=mdx_batch_size)
+        return sources.numpy() * vc # 1.021 volume compensation
     
-    for shift in tqdm(shifts, position=0):
+    acc = np.zeros(mix.shape, dtype=np.float32)
+    for k, shift in enumerate(tqdm(shifts, position=0)):
+        current_progress().start_shift(k, len(shifts))
         shifted_mix = np.concatenate((mix[:, -shift:], mix[:, :-shift]), axis=-1)
-        sources = demix(shifted_mix, device, models, infer_session, overlap) * vc # 1.021 volume compensation
-        restored_sources = np.concatenate((sources[..., shift:], sources[..., :shift]), axis=-1)
-        results.append(restored_sources)
-        
-    sources = np.mean(results, axis=0)
+        sources = demix(shifted_mix, device, models, infer_session, overlap, normalize=normalize, batch_size=batch_size, polarity=polarity)
+        sources *= vc # 1.021 volume compensation
+        add_unshifted(acc, sources, shift)
+        del sources
+
+    acc /= len(shifts)
     
-    return sources
+    return acc
 
-def demix(mix, device, models, infer_session, overlap=0.2):
-    start_time = time()
+def onnx_batch_size(infer_session, batch_size):
+    """
+    Number of chunks to send per ONNX run. Models exported with a dynamic batch axis take any batch,
+    models with a fixed one only take exactly that many chunks.
+    Returns (batch size, True if the batch axis is fixed)
+    """
+    batch_axis = infer_session.get_inputs()[0].shape[0]
+    if isinstance(batch_axis, int) and batch_axis > 0:
+        return batch_axis, True
+    return max(1, int(batch_size)), False
+
+
+def demucs_polarity_ensemble(model, audio, shifts=0, overlap=0.25, batched=False):
+    """
+    Sign-flip ensemble of a Demucs model: 0.5 * f(x) + 0.5 * -f(-x).
+    With batched=True both polarities go through apply_model as one batch of two.
+    """
+    if batched:
+        out = apply_model(model, torch.cat((audio, -audio), dim=0), shifts=shifts, overlap=overlap).cpu().numpy()
+        return 0.5 * out[0] + 0.5 * -out[1]
+    return 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy() \
+           + 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
+
+
+def mdx_chunking(model, length):
+    """
+    Chunk size of an MDX model and the zero padding demix puts around a mix of `length` samples.
+    Returns (chunk_size, trim, pad)
+    """
+    trim = model.n_fft // 2
+    chunk_size = model.hop * (model.dim_t - 1)
+    gen_size = chunk_size - 2 * trim
+    pad = gen_size + trim - (length % gen_size)
+    return chunk_size, trim, pad
+
+
+def onnx_run(infer_session, stft_res, fixed_batch_size=0):
+    """
+    Run an ONNX MDX model on a batch of spectrograms.
+    With fixed_batch_size the batch is cut into pieces of the size the model was exported with,
+    the last piece is filled up with silence and the extra outputs are dropped.
+    """
+    if not fixed_batch_size:
+        with model_call('onnx run'):
+            return infer_session.run(None, {'input': stft_res})[0]
+    res = []
+    for i in range(0, stft_res.shape[0], fixed_batch_size):
+        piece = stft_res[i:i + fixed_batch_size]
+        if piece.shape[0] < fixed_batch_size:
+            piece = np.concatenate((piece, np.zeros((fixed_batch_size - piece.shape[0], ) + piece.shape[1:], dtype=piece.dtype)))
+        with model_call('onnx run'):
+            res.append(infer_session.run(None, {'input': piece})[0])
+    return np.concatenate(res)[:stft_res.shape[0]]
+
+
+def onnx_forward(model, infer_session, mix_wave, fixed_batch_size=0, polarity=False):
+    """
+    Separate a batch of chunks (batch, 2, chunk_size) with an ONNX MDX model.
+    With polarity=True the sign-flip ensemble 0.5 * f(x) + 0.5 * -f(-x) is computed in the same call:
+    STFT(-x) is just -STFT(x), so the spectrogram is computed once and both polarities go through
+    the model as one batch, and the combined output needs only one iSTFT.
+    """
+    batch = mix_wave.shape[0]
+    stft_res = model.stft(mix_wave)
+    stft_res[:, :, :3, :] *= 0 
+    stft_res = stft_res.cpu().numpy()
+    if polarity:
+        stft_res = np.concatenate((stft_res, -stft_res))
+    res = onnx_run(infer_session, stft_res, fixed_batch_size)
+    if polarity:
+        res = 0.5 * res[:batch] - 0.5 * res[batch:]
+    ten = torch.from_numpy(res)
+    return model.istft(ten.to(mix_wave.device))
+
+
+def demix(mix, device, models, infer_session, overlap=0.2, normalize='counter', batch_size=1, polarity=False):
     sources = []
     n_sample = mix.shape[1]
-    n_fft = models[0].n_fft
-    n_bins = n_fft//2+1
-    trim = n_fft//2
-    hop = models[0].hop
-    dim_f = models[0].dim_f
-    dim_t = models[0].dim_t # * 2
-    chunk_size = hop * (dim_t -1)
+    chunk_size, trim, pad = mdx_chunking(models[0], mix.shape[-1])
     org_mix = mix
     tar_waves_ = []
-    mdx_batch_size = 1
+    mdx_batch_size, fixed_batch = onnx_batch_size(infer_session, batch_size)
     overlap = overlap
-    gen_size = chunk_size-2*trim
-    pad = gen_size + trim - ((mix.shape[-1]) % gen_size)
     
     mixture = np.concatenate((np.zeros((2, trim), dtype='float32'), mix, np.zeros((2, pad), dtype='float32')), 1)
 
     step = int((1 - overlap) * chunk_size)
-    result = np.zeros((1, 2, mixture.shape[-1]), dtype=np.float32)
-    divider = np.zeros((1, 2, mixture.shape[-1]), dtype=np.float32)
-    total = 0
-    total_chunks = (mixture.shape[-1] + step - 1) // step
-
-    for i in range(0, mixture.shape[-1], step):
-        total += 1
-        start = i
-        end = min(i + chunk_size, mixture.shape[-1])
-        chunk_size_actual = end - start
-
-        if overlap == 0:
-            window = None
-        else:
-            window = np.hanning(chunk_size_actual)
-            window = np.tile(window[None, None, :], (1, 2, 1))
-
-        mix_part_ = mixture[:, start:end]
-        if end != i + chunk_size:
-            pad_size = (i + chunk_size) - end
-            mix_part_ = np.concatenate((mix_part_, np.zeros((2, pad_size), dtype='float32')), axis=-1)
-        
-        
-        mix_part = torch.tensor([mix_part_], dtype=torch.float32).to(device)
-        mix_waves = mix_part.split(mdx_batch_size)
-        
-        with torch.no_grad():
-            for mix_wave in mix_waves:
-                _ort = infer_session
-                stft_res = models[0].stft(mix_wave)
-                stft_res[:, :, :3, :] *= 0 
-                res = _ort.run(None, {'input': stft_res.cpu().numpy()})[0]
-                ten = torch.tensor(res)
-                tar_waves = models[0].istft(ten.to(device))
-                tar_waves = tar_waves.cpu().detach().numpy()
-                
-                if window is not None:
-                    tar_waves[..., :chunk_size_actual] *= window 
-                    divider[..., start:end] += window
-                else:
-                    divider[..., start:end] += 1
-                result[..., start:end] += tar_waves[..., :end-start]
-
-
-    tar_waves = result / divider
+    plan = get_chunk_plan(mixture.shape[-1], chunk_size, step, 'hanning' if overlap != 0 else 'ones')
+    accumulator = OverlapAdd((1, 2), plan, normalize=normalize)
+    mixture = torch.from_numpy(mixture).float()
+
+    tracker = current_progress()
+    tracker.start_chunks(len(plan))
+    with torch.no_grad():
+        for ids in plan.batches(mdx_batch_size):
+            mix_wave = plan.extract(mixture, ids).to(device)
+            tar_waves = onnx_forward(models[0], infer_session, mix_wave, mdx_batch_size if fixed_batch else 0, polarity=polarity)
+            accumulator.add(tar_waves, ids)
+            tracker.advance(len(ids))
+
+    tar_waves = accumulator.finalize().numpy()
     tar_waves_.append(tar_waves)
     tar_waves_ = np.vstack(tar_waves_)[:, :, trim:-trim]
     tar_waves = np.concatenate(tar_waves_, axis=-1)[:, :mix.shape[-1]]
@@ -348,10 +1027,554 @@ def demix(mix, device, models, infer_session, overlap=0.2):
 
     return source
 
+def download_if_missing(remote_url, path):
+    if not os.path.isfile(path):
+        torch.hub.download_url_to_file(remote_url, path)
+
+
+def clip_overlap(overlap):
+    return min(max(float(overlap), 0.0), 0.99)
+
+
+# Weight of every Demucs model (htdemucs_ft, htdemucs, htdemucs_6s, hdemucs_mmi) in the mean of each stem
+DEMUCS_WEIGHTS = {
+    'drums': (18, 2, 4, 9),
+    'bass': (19, 4, 5, 8),
+    'other': (14, 2, 5, 10),
+    'vocals': (10, 1, 8, 9),
+}
+
+
+def demucs_weights(options):
+    """ Stem -> weights of the Demucs models, from the demucs_weights_* options or DEMUCS_WEIGHTS """
+    return {stem: np.array(options.get(f'demucs_weights_{stem}') or default) for stem, default in DEMUCS_WEIGHTS.items()}
+
+
+def run_demix_new(loaded, mix, device, options, dim_t=256):
+    model, config = loaded
+    return demix_new_wrapper(
+        mix,
+        device,
+        model,
+        config,
+        dim_t=dim_t,
+        batch_size=options.get('batch_size', 1),
+        normalize=options.get('overlap_norm', 'counter'),
+        single_pass=options.get('single_pass_shifts', False)
+    )
+
+
+def run_vitlarge(loaded, mix, device, options):
+    model, config = loaded
+    vocals, instrum = demix_full_vitlarge(
+        mix,
+        device,
+        model,
+        batch_size=options.get('batch_size', 1),
+        normalize=options.get('overlap_norm', 'counter'),
+        single_pass=options.get('single_pass_shifts', False)
+    )
+    return vocals
+
+
+def run_mdx(loaded, mix, device, options, vc=1.0):
+    mdx_models, infer_session = loaded
+    kwargs = dict(
+        overlap=clip_overlap(options['overlap_VOCFT']),
+        vc=vc,
+        bigshifts=options['BigShifts'] // 3,
+        normalize=options.get('overlap_norm', 'counter'),
+        batch_size=options.get('batch_size_onnx', 1),
+        single_pass=options.get('single_pass_shifts', False)
+    )
+    if options.get('polarity_batch', False):
+        # Both polarities in one batch: 0.5 * f(x) + 0.5 * -f(-x)
+        return demix_wrapper(mix, device, mdx_models, infer_session, polarity=True, **kwargs)
+    current_progress().start_pass(0, 2)
+    sources = 0.5 * demix_wrapper(mix, device, mdx_models, infer_session, **kwargs)
+    current_progress().start_pass(1, 2)
+    sources += 0.5 * -demix_wrapper(-mix, device, mdx_models, infer_session, **kwargs)
+    return sources
+
+
+def run_demucs(loaded, audio, device, options, polarity=True, merge_extra_stems=False):
+    """
+    Demucs pass over `audio` (1, channels, samples) tensor, returns drums, bass, other, vocals stems
+        polarity - average with the pass over the inverted audio
+        merge_extra_stems - fold guitar and piano of 6 stem models into other
+    """
+    model, config = loaded
+    overlap = clip_overlap(options['overlap_demucs'])
+    # apply_model has no chunk callback, the whole pass counts as one chunk
+    tracker = current_progress()
+    tracker.start_chunks(1)
+    with model_call():
+        if polarity:
+            out = demucs_polarity_ensemble(model, audio, shifts=0, overlap=overlap, batched=options.get('polarity_batch', False))
+        else:
+            out = apply_model(model, audio, shifts=0, overlap=overlap)[0].cpu().numpy()
+    if merge_extra_stems:
+        # More stems need to add
+        out[2] = out[2] + out[4] + out[5]
+        out = out[:4]
+    tracker.advance(1)
+    return out
+
+
+class ModelSpec:
+    """
+    Declarative description of one model of the ensemble
+        name - model name, as in the use_* / weight_* options
+        checkpoint, checkpoint_url - weights (.ckpt or .onnx) file in the models folder and where to get it,
+                      None for pretrained Demucs models which are fetched by demucs itself
+        config, config_url - YAML config in the models folder and where to get it (torch models only)
+        constructor - builds the model: from its config for torch models, from the device for ONNX models
+                      (the STFT helper used around the ONNX session), without arguments for pretrained models
+        demix - runs the model: demix(loaded, mix, device, options) -> separated stem(s)
+        stem - 'vocals' or 'instrum', instrumental outputs are subtracted from the mix
+        pass_options - options the output of demix depends on, its stem cache key and stage are keyed by them
+    """
+    def __init__(self, name, checkpoint, checkpoint_url, constructor, demix, config=None, config_url=None, stem='vocals',
+                 pass_options=('BigShifts', 'overlap_norm', 'single_pass_shifts')):
+        self.name = name
+        self.checkpoint = checkpoint
+        self.checkpoint_url = checkpoint_url
+        self.config = config
+        self.config_url = config_url
+        self.constructor = constructor
+        self.demix = demix
+        self.stem = stem
+        self.pass_options = tuple(pass_options)
+
+    @property
+    def is_onnx(self):
+        return self.checkpoint is not None and self.checkpoint.endswith('.onnx')
+
+
+# Options an EnsembleDemucsMDXMusicSeparationModel is built with, a change of any of them needs a new instance.
+# BSRoformer_model isn't one, the registry follows it (see ModelRegistry.update)
+MODEL_OPTIONS = ('cpu', 'large_gpu', 'single_onnx', 'models_memory_limit', 'evict_to', 'stem_cache_dir', 'cache_size')
+
+
+def get_model_specs(options):
+    uvr_models = 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/'
+    uvr_configs = 'https://raw.githubusercontent.com/TRvlvr/application_data/main/mdx_model_data/mdx_c_configs/'
+    segm_models = 'https://github.com/ZFTurbo/Music-Source-Separation-Training/releases/download/v1.0.0/'
+    if options.get("BSRoformer_model") == "ep_368_1296":
+        bs_roformer_name = "model_bs_roformer_ep_368_sdr_12.9628"
+    else:
+        bs_roformer_name = "model_bs_roformer_ep_317_sdr_12.9755"
+
+    return [
+        ModelSpec(
+            "BSRoformer",
+            f'{bs_roformer_name}.ckpt', uvr_models + f'{bs_roformer_name}.ckpt',
+            constructor=lambda config: BSRoformer(**dict(config.model)),
+            demix=functools.partial(run_demix_new, dim_t=1101),
+            config=f'{bs_roformer_name}.yaml', config_url=uvr_configs + f'{bs_roformer_name}.yaml',
+            pass_options=('BigShifts', 'overlap_norm', 'single_pass_shifts', 'BSRoformer_model'),
+        ),
+        ModelSpec(
+            "InstVoc",
+            'MDX23C-8KFFT-InstVoc_HQ.ckpt', uvr_models + 'MDX23C-8KFFT-InstVoc_HQ.ckpt',
+            constructor=TFC_TDF_net,
+            demix=functools.partial(run_demix_new, dim_t=1024),
+            config='model_2_stem_full_band_8k.yaml', config_url=uvr_configs + 'model_2_stem_full_band_8k.yaml',
+        ),
+        ModelSpec(
+            "VitLarge",
+            'model_vocals_segm_models_sdr_9.77.ckpt', segm_models + 'model_vocals_segm_models_sdr_9.77.ckpt',
+            constructor=Segm_Models_Net,
+            demix=run_vitlarge,
+            config='config_vocals_segm_models.yaml', config_url=segm_models + 'config_vocals_segm_models.yaml',
+        ),
+        ModelSpec(
+            "VOCFT",
+            'UVR-MDX-NET-Voc_FT.onnx', uvr_models + 'UVR-MDX-NET-Voc_FT.onnx',
+            constructor=lambda device: get_models('tdf_extra', load=False, device=device, vocals_model_type=2),
+            demix=functools.partial(run_mdx, vc=1.021),
+            pass_options=('overlap_VOCFT', 'BigShifts', 'overlap_norm', 'single_pass_shifts'),
+        ),
+        ModelSpec(
+            "InstHQ4",
+            'UVR-MDX-NET-Inst_HQ_4.onnx', uvr_models + 'UVR-MDX-NET-Inst_HQ_4.onnx',
+            constructor=lambda device: get_models('tdf_extra', load=False, device=device, vocals_model_type=3),
+            demix=functools.partial(run_mdx, vc=1.019),
+            stem='instrum',
+            pass_options=('overlap_VOCFT', 'BigShifts', 'overlap_norm', 'single_pass_shifts'),
+        ),
+        ModelSpec(
+            "htdemucs_ft", None, None,
+            constructor=lambda: pretrained.get_model('htdemucs_ft'),
+            demix=run_demucs,
+            stem='all',
+            pass_options=('overlap_demucs', ),
+        ),
+        ModelSpec(
+            "htdemucs", None, None,
+            constructor=lambda: pretrained.get_model('htdemucs'),
+            demix=run_demucs,
+            stem='all',
+            pass_options=('overlap_demucs', ),
+        ),
+        ModelSpec(
+            "htdemucs_6s", None, None,
+            constructor=lambda: pretrained.get_model('htdemucs_6s'),
+            demix=functools.partial(run_demucs, polarity=False, merge_extra_stems=True),
+            stem='all',
+            pass_options=('overlap_demucs', ),
+        ),
+        ModelSpec(
+            "hdemucs_mmi", None, None,
+            constructor=lambda: pretrained.get_model('hdemucs_mmi'),
+            demix=run_demucs,
+            stem='all',
+            pass_options=('overlap_demucs', ),
+        ),
+    ]
+
+
+class ModelRegistry:
+    """
+    Loads models on first use and keeps the most recently used ones on the device.
+    When the models on the device take more than `memory_limit` bytes, the least recently used ones
+    are moved back to CPU (evict_to='cpu') or dropped and loaded from disk again on next use (evict_to='disk').
+    ONNX sessions can't be moved between devices, so they are always dropped.
+    """
+    def __init__(self, specs, device, model_folder, memory_limit=0, evict_to='cpu'):
+        if evict_to not in ('cpu', 'disk'):
+            raise ValueError('Unknown eviction target: {}'.format(evict_to))
+        self.specs = {spec.name: spec for spec in specs}
+        self.device = device
+        self.model_folder = model_folder
+        self.memory_limit = memory_limit
+        self.evict_to = evict_to
+        if self.device == 'cpu':
+            # Nowhere to offload to
+            self.evict_to = 'disk'
+        self.loaded = collections.OrderedDict()
+        self.on_device = set()
+        # ONNX sessions loaded while it is set write ONNX Runtime traces there
+        self.profile_folder = None
+
+    def __contains__(self, name):
+        return name in self.specs
+
+    def load(self, name):
+        spec = self.specs[name]
+        print("Loading {} into memory".format(name))
+        if spec.checkpoint is None:
+            model = spec.constructor()
+            model.eval()
+            return [model, None]
+        download_if_missing(spec.checkpoint_url, self.model_folder + spec.checkpoint)
+        if spec.is_onnx:
+            if self.device == 'cpu':
+                providers = ["CPUExecutionProvider"]
+            else:
+                providers = ["CUDAExecutionProvider"]
+            session_options = ort.SessionOptions()
+            if self.profile_folder is not None:
+                session_options.enable_profiling = True
+                session_options.profile_file_prefix = os.path.join(self.profile_folder, name)
+            infer_session = ort.InferenceSession(
+                self.model_folder + spec.checkpoint,
+                session_options,
+                providers=providers,
+                provider_options=[{"device_id": 0}],
+            )
+            return [spec.constructor(self.device), infer_session]
+
+        download_if_missing(spec.config_url, self.model_folder + spec.config)
+        with open(self.model_folder + spec.config) as f:
+            config = ConfigDict(yaml.load(f, Loader=yaml.FullLoader))
+        model = spec.constructor(config)
+        model.load_state_dict(torch.load(self.model_folder + spec.checkpoint, map_location='cpu'))
+        model.eval()
+        return [model, config]
+
+    def memory(self, name):
+        """ Bytes a model takes on the device """
+        spec = self.specs[name]
+        if spec.is_onnx:
+            return os.path.getsize(self.model_folder + spec.checkpoint)
+        model = self.loaded[name][0]
+        return sum(t.numel() * t.element_size() for t in itertools.chain(model.parameters(), model.buffers()))
+
+    def evict(self, name, drop=False):
+        """ Moves a model off the device, drop - remove it from memory whatever evict_to is """
+        if name not in self.loaded:
+            return
+        if self.evict_to == 'cpu' and not self.specs[name].is_onnx and not drop:
+            self.loaded[name][0] = self.loaded[name][0].cpu()
+        else:
+            del self.loaded[name]
+        self.on_device.discard(name)
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def update(self, specs):
+        """ Takes the specs for the current options (e.g. another BSRoformer_model), models whose files changed are dropped """
+        for spec in specs:
+            old = self.specs.get(spec.name)
+            if old is not None and (old.checkpoint, old.config) == (spec.checkpoint, spec.config):
+                continue
+            self.evict(spec.name, drop=True)
+            self.specs[spec.name] = spec
+
+    def start_profiling(self, folder):
+        """ ONNX sessions record their nodes into `folder` until end_profiling, sessions loaded without it are dropped """
+        self.profile_folder = folder
+        for name in list(self.loaded):
+            if self.specs[name].is_onnx and not self.loaded[name][1].get_session_options().enable_profiling:
+                self.evict(name)
+
+    def end_profiling(self):
+        """
+        Ends the profiling of the ONNX sessions, a session records only once, so they are dropped.
+        Returns model name -> ONNX Runtime trace file
+        """
+        self.profile_folder = None
+        traces = {}
+        for name in list(self.loaded):
+            if self.specs[name].is_onnx and self.loaded[name][1].get_session_options().enable_profiling:
+                traces[name] = self.loaded[name][1].end_profiling()
+                self.evict(name)
+        return traces
+
+    def get(self, name):
+        """
+        Returns [model, config] for torch models and [mdx_models, infer_session] for ONNX models
+        """
+        if name not in self.loaded:
+            self.loaded[name] = self.load(name)
+        self.loaded.move_to_end(name)
+        if name not in self.on_device:
+            if not self.specs[name].is_onnx:
+                self.loaded[name][0] = self.loaded[name][0].to(self.device)
+            self.on_device.add(name)
+            if self.memory_limit > 0:
+                for other in list(self.loaded.keys()):
+                    if sum(self.memory(n) for n in self.on_device) <= self.memory_limit:
+                        break
+                    if other != name and other in self.on_device:
+                        self.evict(other)
+        return self.loaded[name]
+
+
+def audio_digest(audio):
+    h = hashlib.sha256()
+    audio = np.ascontiguousarray(audio)
+    h.update(str((audio.shape, audio.dtype.str)).encode())
+    h.update(audio.data)
+    return h.hexdigest()
+
+
+def model_output_key(audio_key, spec, options):
+    """ Cache key of a single model pass: its input, the model and the options the pass depends on """
+    relevant = {k: options.get(k) for k in spec.pass_options}
+    relevant['model'] = spec.name
+    return hashlib.sha256((audio_key + json.dumps(relevant, sort_keys=True, default=str)).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk cache of finished stems keyed by the decoded audio and every option that changes the output.
+    An entry is a folder of .npy stems, least recently used entries are removed when the folder grows over max_size bytes.
+    Stems are stored as float32 (lr_filter promotes to float64, which would double the size of an entry).
+    """
+    KEY_OPTIONS = ('BSRoformer_model', 'BigShifts', 'vocals_only', 'input_gain', 'restore_gain', 'filter_vocals',
+                   'crossover', 'overlap_norm', 'single_pass_shifts')
+
+    def __init__(self, folder, max_size=0):
+        self.folder = folder
+        self.max_size = max_size
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, audio, options):
+        relevant = {k: v for k, v in options.items() if k in self.KEY_OPTIONS or k.startswith(('use_', 'weight_', 'overlap_', 'demucs_weights_'))}
+        return hashlib.sha256((audio_digest(audio) + json.dumps(relevant, sort_keys=True, default=str)).encode()).hexdigest()
+
+    def get(self, key):
+        """ Returns (stems, sample_rates) or None """
+        path = os.path.join(self.folder, key)
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            stems = collections.OrderedDict((name, np.load(os.path.join(path, name + '.npy'))) for name in meta['stems'])
+        except (OSError, ValueError, KeyError):
+            return None
+        os.utime(path)
+        return stems, meta['sample_rates']
+
+    def put(self, key, stems, sample_rates):
+        tmp = tempfile.mkdtemp(dir=self.folder, prefix='.tmp_')
+        for name, stem in stems.items():
+            np.save(os.path.join(tmp, name + '.npy'), np.asarray(stem, dtype=np.float32))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'stems': list(stems), 'sample_rates': dict(sample_rates)}, f)
+        try:
+            os.replace(tmp, os.path.join(self.folder, key))
+        except OSError:
+            # already cached by another job
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        if self.max_size <= 0:
+            return
+        entries = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.startswith('.tmp_') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(e.stat().st_size for e in os.scandir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+class StageGraph:
+    """
+    Pipeline of named stages. Every stage declares the stages it takes as inputs and the options it reads,
+    its result is memoized and computed again only when one of those changed.
+    Sources are values set from outside, a new value of a source drops all memoized results.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.memo = {}
+
+    def add(self, name, fn, inputs=(), options=()):
+        """
+        fn(options, *input values) computes the stage.
+        inputs - names of input stages or sources, or a function of the options returning them
+        """
+        self.stages[name] = (fn, inputs, tuple(options))
+
+    def source(self, name, value, signature):
+        if name in self.memo and self.memo[name][0] != signature:
+            self.memo.clear()
+        self.memo[name] = (signature, value)
+
+    def run(self, name, options):
+        return self._run(name, options)[1]
+
+    def _run(self, name, options):
+        if name not in self.stages:
+            return self.memo[name]
+        fn, inputs, keys = self.stages[name]
+        if callable(inputs):
+            inputs = inputs(options)
+        deps = [self._run(i, options) for i in inputs]
+        signature = hashlib.sha256(json.dumps(
+            [[d[0] for d in deps], {k: options.get(k) for k in keys}], sort_keys=True, default=str).encode()).hexdigest()
+        memo = self.memo.get(name)
+        if memo is None or memo[0] != signature:
+            memo = self.memo[name] = (signature, fn(options, *[d[1] for d in deps]))
+        return memo
+
+
+class SpillStore:
+    """
+    Storage for full length intermediate arrays. With a folder they are np.memmap files in it and
+    the OS pages them in and out, without one they are plain numpy arrays.
+    Files are anonymous temporary files, they are removed as soon as the array is released.
+    """
+    def __init__(self, folder=None):
+        self.folder = folder
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    def zeros(self, shape, dtype=np.float32):
+        if not self.folder:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(tempfile.TemporaryFile(dir=self.folder), dtype=dtype, mode='w+', shape=tuple(shape))
+
+    def put(self, arr):
+        if not self.folder:
+            return arr
+        out = self.zeros(arr.shape, arr.dtype)
+        out[...] = arr
+        return out
+
+
+def combine_vocals(outputs_by_model, weights, crossover=12000, store=None):
+    """
+    Vocals ensemble: weighted mean of the model outputs below the crossover frequency, InstVoc alone above it.
+        outputs_by_model - model name -> (channels, samples) vocals
+        weights - model name -> weight
+    Returns (samples, channels) vocals
+    """
+    store = store or SpillStore()
+    first = next(iter(outputs_by_model.values()))
+    vocals_combined = store.zeros(first.shape, first.dtype)
+
+    for model_name, output in outputs_by_model.items():
+        vocals_combined += output * weights[model_name]
+
+    vocals_combined /= np.sum([weights[model_name] for model_name in outputs_by_model])
+
+    vocals_low = lr_filter(vocals_combined.T, crossover, 'lowpass') # * 1.01055  # remember to check if new final finetuned volume compensation is needed  !
+    vocals_high = lr_filter(outputs_by_model['InstVoc'].T, crossover, 'highpass')
+    
+    vocals = vocals_low + vocals_high
+    #vocals = vocals_combined.T
+    return store.put(vocals)
+
+
+def combine_demucs(mixed_sound_array, vocals, out, store=None):
+    """
+    Drums, bass and other stems from the weighted mean of Demucs outputs `out` (drums, bass, other, vocals),
+    each one is averaged with the residual of the mix after the other stems are removed
+    """
+    store = store or SpillStore()
+    separated_music_arrays = {}
+
+    # other
+    res = mixed_sound_array - vocals - out[0].T - out[1].T
+    res = np.clip(res, -1, 1)
+    separated_music_arrays['other'] = (2 * res + out[2].T) / 3.0
+
+    # drums
+    res = mixed_sound_array - vocals - out[1].T - out[2].T
+    res = np.clip(res, -1, 1)
+    separated_music_arrays['drums'] = (res + 2 * out[0].T.copy()) / 3.0
+
+    # bass
+    res = mixed_sound_array - vocals - out[0].T - out[2].T
+    res = np.clip(res, -1, 1)
+    separated_music_arrays['bass'] = (res + 2 * out[1].T) / 3.0
+
+    bass = separated_music_arrays['bass']
+    drums = separated_music_arrays['drums']
+    other = separated_music_arrays['other']
+
+    separated_music_arrays['other'] = store.put(mixed_sound_array - vocals - bass - drums)
+    separated_music_arrays['drums'] = store.put(mixed_sound_array - vocals - bass - other)
+    separated_music_arrays['bass'] = store.put(mixed_sound_array - vocals - drums - other)
+    return separated_music_arrays
+
+
 class EnsembleDemucsMDXMusicSeparationModel:
     """
     Doesn't do any separation just passes the input back as output
     """
+    vocals_model_names = [
+        "BSRoformer",
+        "InstVoc",
+        "VitLarge",
+        "VOCFT",
+        "InstHQ4"
+    ]
+
     def __init__(self, options):
         """
             options - user options
@@ -365,21 +1588,7 @@ class EnsembleDemucsMDXMusicSeparationModel:
             if options['cpu']:
                 device = 'cpu'
         # print('Use device: {}'.format(device))
-        self.single_onnx = False
-        if 'single_onnx' in options:
-            if options['single_onnx']:
-                self.single_onnx = True
-                # print('Use single vocal ONNX')
-        self.overlap_demucs = float(options['overlap_demucs'])
-        self.overlap_MDX = float(options['overlap_VOCFT'])
-        if self.overlap_demucs > 0.99:
-            self.overlap_demucs = 0.99
-        if self.overlap_demucs < 0.0:
-            self.overlap_demucs = 0.0
-        if self.overlap_MDX > 0.99:
-            self.overlap_MDX = 0.99
-        if self.overlap_MDX < 0.0:
-            self.overlap_MDX = 0.0
+        # Overlaps are read from the options of every call, see run_mdx and run_demucs
         model_folder = os.path.dirname(os.path.realpath(__file__)) + '/models/'
         """
         
@@ -392,163 +1601,60 @@ class EnsembleDemucsMDXMusicSeparationModel:
         self.model_vocals_only = model_vocals
         """
 
-        if options['vocals_only'] is False:
-            self.models = []
-            self.weights_vocals = np.array([10, 1, 8, 9])
-            self.weights_bass = np.array([19, 4, 5, 8])
-            self.weights_drums = np.array([18, 2, 4, 9])
-            self.weights_other = np.array([14, 2, 5, 10])
-
-            model1 = pretrained.get_model('htdemucs_ft')
-            model1.to(device)
-            self.models.append(model1)
-
-            model2 = pretrained.get_model('htdemucs')
-            model2.to(device)
-            self.models.append(model2)
-
-            model3 = pretrained.get_model('htdemucs_6s')
-            model3.to(device)
-            self.models.append(model3)
-
-            model4 = pretrained.get_model('hdemucs_mmi')
-            model4.to(device)
-            self.models.append(model4)
-
-            if 0:
-                for model in self.models:
-                  pass
-                  # print(model.sources)
-            '''
-            ['drums', 'bass', 'other', 'vocals']
-            ['drums', 'bass', 'other', 'vocals']
-            ['drums', 'bass', 'other', 'vocals', 'guitar', 'piano']
-            ['drums', 'bass', 'other', 'vocals']
-            '''
-
-            """
-            #BS-RoformerDRUMS+BASS init
-            print("Loading BS-RoformerDB into memory")
-            remote_url_bsrofoDB = 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/model_bs_roformer_ep_937_sdr_10.5309.ckpt'
-            remote_url_conf_bsrofoDB = 'https://raw.githubusercontent.com/TRvlvr/application_data/main/mdx_model_data/mdx_c_configs/model_bs_roformer_ep_937_sdr_10.5309.yaml'
-            if not os.path.isfile(model_folder+'model_bs_roformer_ep_937_sdr_10.5309.ckpt'):
-                torch.hub.download_url_to_file(remote_url_bsrofoDB, model_folder+'model_bs_roformer_ep_937_sdr_10.5309.ckpt')
-            if not os.path.isfile(model_folder+'model_bs_roformer_ep_937_sdr_10.5309.yaml'):
-                torch.hub.download_url_to_file(remote_url_conf_bsrofoDB, model_folder+'model_bs_roformer_ep_937_sdr_10.5309.yaml')
-
-            with open(model_folder + 'model_bs_roformer_ep_937_sdr_10.5309.yaml') as f:
-                config_bsrofoDB = ConfigDict(yaml.load(f, Loader=yaml.FullLoader))
-
-            self.model_bsrofoDB = BSRoformer(**dict(config_bsrofoDB.model))
-            self.config_bsrofoDB = config_bsrofoDB
-            self.model_bsrofoDB.load_state_dict(torch.load(model_folder+'model_bs_roformer_ep_937_sdr_10.5309.ckpt'))
-            self.device = torch.device(device)
-            self.model_bsrofoDB = self.model_bsrofoDB.to(device)
-            self.model_bsrofoDB.eval()
-            """
-
-        if device == 'cpu':
-            providers = ["CPUExecutionProvider"]
-        else:
-            providers = ["CUDAExecutionProvider"]
-        
-        
-        #BS-RoformerVOC init
-        print("Loading BS-Roformer into memory")
-        if options["BSRoformer_model"] == "ep_368_1296":
-            model_name = "model_bs_roformer_ep_368_sdr_12.9628"
-        else:
-            model_name = "model_bs_roformer_ep_317_sdr_12.9755"
-        remote_url_bsrofo = f'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/{model_name}.ckpt'
-        remote_url_conf_bsrofo = f'https://raw.githubusercontent.com/TRvlvr/application_data/main/mdx_model_data/mdx_c_configs/{model_name}.yaml'
-        if not os.path.isfile(model_folder+f'{model_name}.ckpt'):
-            torch.hub.download_url_to_file(remote_url_bsrofo, model_folder+f'{model_name}.ckpt')
-        if not os.path.isfile(model_folder+f'{model_name}.yaml'):
-            torch.hub.download_url_to_file(remote_url_conf_bsrofo, model_folder+f'{model_name}.yaml')
-
-        with open(model_folder + f'{model_name}.yaml') as f:
-            config_bsrofo = ConfigDict(yaml.load(f, Loader=yaml.FullLoader))
-
-        self.model_bsrofo = BSRoformer(**dict(config_bsrofo.model))
-        self.config_bsrofo = config_bsrofo
-        self.model_bsrofo.load_state_dict(torch.load(model_folder+f'{model_name}.ckpt'))
-        self.device = torch.device(device)
-        self.model_bsrofo = self.model_bsrofo.to(device)
-        self.model_bsrofo.eval()
-        
-        
-        #MDXv3 init
-        print("Loading InstVoc into memory")
-        remote_url_mdxv3 = 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/MDX23C-8KFFT-InstVoc_HQ.ckpt'
-        remote_url_conf_mdxv3 = 'https://raw.githubusercontent.com/TRvlvr/application_data/main/mdx_model_data/mdx_c_configs/model_2_stem_full_band_8k.yaml'
-        if not os.path.isfile(model_folder+'MDX23C-8KFFT-InstVoc_HQ.ckpt'):
-            torch.hub.download_url_to_file(remote_url_mdxv3, model_folder+'MDX23C-8KFFT-InstVoc_HQ.ckpt')
-        if not os.path.isfile(model_folder+'model_2_stem_full_band_8k.yaml'):
-            torch.hub.download_url_to_file(remote_url_conf_mdxv3, model_folder+'model_2_stem_full_band_8k.yaml')
-
-        with open(model_folder + 'model_2_stem_full_band_8k.yaml') as f:
-            config_mdxv3 = ConfigDict(yaml.load(f, Loader=yaml.FullLoader))
-
-        self.config_mdxv3 = config_mdxv3
-        self.model_mdxv3 = TFC_TDF_net(config_mdxv3)
-        self.model_mdxv3.load_state_dict(torch.load(model_folder+'MDX23C-8KFFT-InstVoc_HQ.ckpt'))
+        # Demucs is only used for 4 stems, but it's set up anyway so the same instance serves both modes.
+        # Weights of the Demucs models come from the demucs_weights_* options, see DEMUCS_WEIGHTS
+
+        # Demucs models are loaded on first use and then kept in the registry for the following tracks.
+        # With large_gpu all of them stay on the device, else each one goes back to CPU after its pass
+        self.demucs_model_names = ['htdemucs_ft', 'htdemucs', 'htdemucs_6s', 'hdemucs_mmi']
+        self.large_gpu = bool(options.get('large_gpu', False))
+
+        '''
+        ['drums', 'bass', 'other', 'vocals']
+        ['drums', 'bass', 'other', 'vocals']
+        ['drums', 'bass', 'other', 'vocals', 'guitar', 'piano']
+        ['drums', 'bass', 'other', 'vocals']
+        '''
+
+        """
+        #BS-RoformerDRUMS+BASS init
+        print("Loading BS-RoformerDB into memory")
+        remote_url_bsrofoDB = 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/model_bs_roformer_ep_937_sdr_10.5309.ckpt'
+        remote_url_conf_bsrofoDB = 'https://raw.githubusercontent.com/TRvlvr/application_data/main/mdx_model_data/mdx_c_configs/model_bs_roformer_ep_937_sdr_10.5309.yaml'
+        if not os.path.isfile(model_folder+'model_bs_roformer_ep_937_sdr_10.5309.ckpt'):
+            torch.hub.download_url_to_file(remote_url_bsrofoDB, model_folder+'model_bs_roformer_ep_937_sdr_10.5309.ckpt')
+        if not os.path.isfile(model_folder+'model_bs_roformer_ep_937_sdr_10.5309.yaml'):
+            torch.hub.download_url_to_file(remote_url_conf_bsrofoDB, model_folder+'model_bs_roformer_ep_937_sdr_10.5309.yaml')
+
+        with open(model_folder + 'model_bs_roformer_ep_937_sdr_10.5309.yaml') as f:
+            config_bsrofoDB = ConfigDict(yaml.load(f, Loader=yaml.FullLoader))
+
+        self.model_bsrofoDB = BSRoformer(**dict(config_bsrofoDB.model))
+        self.config_bsrofoDB = config_bsrofoDB
+        self.model_bsrofoDB.load_state_dict(torch.load(model_folder+'model_bs_roformer_ep_937_sdr_10.5309.ckpt'))
         self.device = torch.device(device)
-        self.model_mdxv3 = self.model_mdxv3.to(device)
-        self.model_mdxv3.eval()
-        
-        #VitLarge init
-        if options['use_VitLarge'] is True:
-            print("Loading VitLarge into memory")
-            remote_url_vitlarge = 'https://github.com/ZFTurbo/Music-Source-Separation-Training/releases/download/v1.0.0/model_vocals_segm_models_sdr_9.77.ckpt'
-            remote_url_vl_conf = 'https://github.com/ZFTurbo/Music-Source-Separation-Training/releases/download/v1.0.0/config_vocals_segm_models.yaml'
-            if not os.path.isfile(model_folder+'model_vocals_segm_models_sdr_9.77.ckpt'):
-                torch.hub.download_url_to_file(remote_url_vitlarge, model_folder+'model_vocals_segm_models_sdr_9.77.ckpt')
-            if not os.path.isfile(model_folder+'config_vocals_segm_models.yaml'):
-                torch.hub.download_url_to_file(remote_url_vl_conf, model_folder+'config_vocals_segm_models.yaml')
-
-            with open(model_folder + 'config_vocals_segm_models.yaml') as f:
-                config_vl = ConfigDict(yaml.load(f, Loader=yaml.FullLoader))
-
-            self.config_vl = config_vl
-            self.model_vl = Segm_Models_Net(config_vl)
-            self.model_vl.load_state_dict(torch.load(model_folder+'model_vocals_segm_models_sdr_9.77.ckpt'))
-            self.device = torch.device(device)
-            self.model_vl = self.model_vl.to(device)
-            self.model_vl.eval()
-
-        # VOCFT init
-        if options['use_VOCFT']:
-            print("Loading VOCFT into memory")
-            self.mdx_models1 = get_models('tdf_extra', load=False, device=device, vocals_model_type=2)
-            model_path_onnx1 = model_folder + 'UVR-MDX-NET-Voc_FT.onnx'
-            remote_url_onnx1 = 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/UVR-MDX-NET-Voc_FT.onnx'
-            
-            if not os.path.isfile(model_path_onnx1):
-                torch.hub.download_url_to_file(remote_url_onnx1, model_path_onnx1)
-                
-            self.infer_session1 = ort.InferenceSession(
-                model_path_onnx1,
-                providers=providers,
-                provider_options=[{"device_id": 0}],
-            )
-            
-        # InstHQ4 init
-        if options['use_InstHQ4']:
-            print("Loading InstHQ4 into memory")
-            self.mdx_models2 = get_models('tdf_extra', load=False, device=device, vocals_model_type=3)
-            model_path_onnx2 = model_folder + 'UVR-MDX-NET-Inst_HQ_4.onnx'
-            remote_url_onnx2 = 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/UVR-MDX-NET-Inst_HQ_4.onnx'
-            
-            if not os.path.isfile(model_path_onnx2):
-                torch.hub.download_url_to_file(remote_url_onnx2, model_path_onnx2)
-                
-            self.infer_session2 = ort.InferenceSession(
-                model_path_onnx2,
-                providers=providers,
-                provider_options=[{"device_id": 0}],
-            )
-        
-        
+        self.model_bsrofoDB = self.model_bsrofoDB.to(device)
+        self.model_bsrofoDB.eval()
+        """
+
+        # Vocals ensemble models are loaded on first use
+        self.registry = ModelRegistry(
+            get_model_specs(options),
+            device,
+            model_folder,
+            memory_limit=int(float(options.get('models_memory_limit', 0)) * 1024 ** 3),
+            evict_to=options.get('evict_to', 'cpu'),
+        )
+
+        # Raw outputs of single models, reused when only weights, crossover or filter settings change
+        self.stem_cache = None
+        if options.get('stem_cache_dir'):
+            self.stem_cache = ResultCache(options['stem_cache_dir'], int(float(options.get('cache_size', 0)) * 1024 ** 3))
+
+        self.stages = self.build_stages()
+        self.timings = []
+        self.profile = None
+
         self.device = device
         pass
         
@@ -560,6 +1666,127 @@ class EnsembleDemucsMDXMusicSeparationModel:
         else:
             return ['vocals']
 
+    def build_stages(self):
+        """
+        Separation pipeline as a stage graph: vocals models, weighted mix with crossover, vocals filter,
+        instrumental, Demucs and the stems fix-up. Sources are the mix and its digest.
+        """
+        names = self.vocals_model_names
+        stages = StageGraph()
+        for model_name in names:
+            stages.add(model_name, functools.partial(self.vocals_model_stage, model_name), ('mix', 'mix_key'),
+                       self.registry.specs[model_name].pass_options)
+        stages.add('vocals_mix', self.vocals_mix_stage, lambda o: [n for n in names if o[f"use_{n}"]],
+                   [f"use_{n}" for n in names] + [f"weight_{n}" for n in names] + ['crossover'])
+        stages.add('vocals', self.vocals_filter_stage, ('vocals_mix', ), ('filter_vocals', ))
+        stages.add('instrum', self.instrum_stage, ('mix', 'vocals'))
+        stages.add('demucs', self.demucs_stage, ('instrum', ), ['overlap_demucs'] + [f'demucs_weights_{s}' for s in DEMUCS_WEIGHTS])
+        stages.add('stems', self.stems_stage, ('mix', 'vocals', 'demucs'))
+        return stages
+
+    def vocals_model_stage(self, model_name, options, mixed_sound_array, mix_key):
+        tracker = current_progress()
+        tracker.start_stage(model_name)
+
+        def run_vocals_model():
+            print(f'Processing vocals with {model_name} model...')
+            spec = self.registry.specs[model_name]
+            sources = spec.demix(self.registry.get(model_name), mixed_sound_array.T, self.device, options)
+            if spec.stem == 'vocals':
+                return match_array_shapes(sources, mixed_sound_array.T)
+            return mixed_sound_array.T - sources
+
+        vocals_model = SpillStore(options.get('spill_dir')).put(self.model_output(model_name, mix_key, run_vocals_model))
+        tracker.end_stage()
+        return vocals_model
+
+    def vocals_mix_stage(self, options, *outputs):
+        used = [n for n in self.vocals_model_names if options[f"use_{n}"]]
+        print('Processing vocals: DONE!')
+        with current_progress().timed('vocals mix and crossover'):
+            return combine_vocals(dict(zip(used, outputs)), {n: options.get(f"weight_{n}") for n in used},
+                                  options.get('crossover', 12000), SpillStore(options.get('spill_dir')))
+
+    def vocals_filter_stage(self, options, vocals):
+        if options['filter_vocals'] is True:
+            with current_progress().timed('vocals filter'):
+                vocals = SpillStore(options.get('spill_dir')).put(lr_filter(vocals, 50, 'highpass', order=8))
+        return vocals
+
+    def instrum_stage(self, options, mixed_sound_array, vocals):
+        with current_progress().timed('instrumental'):
+            return SpillStore(options.get('spill_dir')).put(mixed_sound_array - vocals)
+
+    def stems_stage(self, options, mixed_sound_array, vocals, out):
+        with current_progress().timed('stems fix-up'):
+            return combine_demucs(mixed_sound_array, vocals, out, SpillStore(options.get('spill_dir')))
+
+    def demucs_stage(self, options, instrum):
+        """ Weighted mean of the Demucs models over the instrumental, (drums, bass, other, vocals) """
+        store = SpillStore(options.get('spill_dir'))
+        """
+        print(f'Processing drums & bass with 2nd BS-Roformer model...')
+        other_bs2 = demix_full_bsrofo(instrum.T, self.device, self.model_bsrofoDB, self.config_bsrofoDB)
+        other_bs2 = match_array_shapes(other_bs2, mixed_sound_array.T)
+        drums_bass_bs2 = mixed_sound_array.T - other_bs2
+        
+        
+        print('Starting Demucs processing...')
+        
+        drums_bass_bs2 = np.expand_dims(drums_bass_bs2.T, axis=0)
+        drums_bass_bs2 = torch.from_numpy(drums_bass_bs2).type('torch.FloatTensor').to(self.device)
+        """
+        audio = np.expand_dims(instrum.T, axis=0)
+        audio = torch.from_numpy(audio).type('torch.FloatTensor').to(self.device)
+        instrum_key = audio_digest(instrum) if self.stem_cache is not None else None
+        weights = demucs_weights(options)
+        demucs_sum = None
+        tracker = current_progress()
+        for i, model_name in enumerate(self.demucs_model_names):
+            tracker.start_stage(model_name)
+
+            def run_demucs_model():
+                print('Processing with {}...'.format(model_name))
+                return self.registry.specs[model_name].demix(self.registry.get(model_name), audio, self.device, options)
+            out = self.model_output(model_name, instrum_key, run_demucs_model)
+            tracker.end_stage()
+            out[0] = weights['drums'][i] * out[0]
+            out[1] = weights['bass'][i] * out[1]
+            out[2] = weights['other'][i] * out[2]
+            out[3] = weights['vocals'][i] * out[3]
+            if demucs_sum is None:
+                demucs_sum = store.zeros(out.shape, out.dtype)
+            demucs_sum += out
+            del out
+            if not self.large_gpu and self.device != 'cpu':
+                self.registry.evict(model_name)
+        out = demucs_sum
+        out[0] = out[0] / weights['drums'].sum()
+        out[1] = out[1] / weights['bass'].sum()
+        out[2] = out[2] / weights['other'].sum()
+        out[3] = out[3] / weights['vocals'].sum()
+        return out
+
+    def model_output(self, model_name, audio_key, run):
+        """ Output of run() for model_name, taken from the stem cache when it is there """
+        if self.stem_cache is None:
+            return run()
+        key = model_output_key(audio_key, self.registry.specs[model_name], options)
+        cached = self.stem_cache.get(key)
+        if cached is not None:
+            print(f'Using cached output of {model_name}')
+            return cached[0]['out']
+        if options.get('recombine_only', False):
+            if model_name in self.demucs_model_names:
+                raise ValueError(f'No cached output of {model_name} for this instrumental. Demucs separates the mix minus the vocals, '
+                                 'so in 4-stem mode --recombine_only only works when the vocals are unchanged (only demucs_weights_* changed). '
+                                 'Use --vocals_only to try other vocals weights, crossover or filter, or run the full separation first')
+            raise ValueError(f'No cached output of {model_name} for this audio and settings, run the full separation first')
+        # float32 like the cached copy, so a hit recombines to the same result as the run that stored it
+        out = np.asarray(run(), dtype=np.float32)
+        self.stem_cache.put(key, {'out': out}, {})
+        return out
+
     def raise_aicrowd_error(self, msg):
         """ Will be used by the evaluator to provide logs, DO NOT CHANGE """
         raise NameError(msg)
@@ -570,12 +1797,14 @@ class EnsembleDemucsMDXMusicSeparationModel:
             sample_rate,
             current_file_number=0,
             total_files=0,
+            progress_callback=None,
     ):
         """
         Implements the sound separation for a single sound file
         Inputs: Outputs from soundfile.read('mixture.wav')
             mixed_sound_array
             sample_rate
+            progress_callback - called with a dict of model, shift, chunk and ETA, see Progress
 
         Outputs:
             separated_music_arrays: Dictionary numpy array of each separated instrument
@@ -588,238 +1817,49 @@ class EnsembleDemucsMDXMusicSeparationModel:
         output_sample_rates = {}
         #print(mixed_sound_array.T.shape)
         #audio = np.expand_dims(mixed_sound_array.T, axis=0)
-        
 
-        overlap_demucs = self.overlap_demucs
-        overlap_MDX = self.overlap_MDX
-        shifts = 0
-        overlap = overlap_demucs
+        # The models follow the options of this call, BSRoformer_model may differ from the one of the last call
+        self.registry.update(get_model_specs(options))
 
-        vocals_model_names = [
-            "BSRoformer",
-            "InstVoc",
-            "VitLarge",
-            "VOCFT",
-            "InstHQ4"
-        ]
-
-        vocals_model_outputs = []
-        weights = []
-
-        for model_name in vocals_model_names:
-
-            if options[f"use_{model_name}"]:
-
-                if model_name == "BSRoformer":
-                    print(f'Processing vocals with {model_name} model...')
-                    sources_bs = demix_new_wrapper(mixed_sound_array.T, self.device, self.model_bsrofo, self.config_bsrofo, dim_t=1101)
-                    vocals_bs = match_array_shapes(sources_bs, mixed_sound_array.T)
-                    vocals_model_outputs.append(vocals_bs)
-                    weights.append(options.get(f"weight_{model_name}"))
-
-
-                if model_name == "InstVoc":
-                    print(f'Processing vocals with {model_name} model...')
-                    sources3 = demix_new_wrapper(mixed_sound_array.T, self.device, self.model_mdxv3, self.config_mdxv3, dim_t=1024)
-                    vocals3 = match_array_shapes(sources3, mixed_sound_array.T)
-                    vocals_model_outputs.append(vocals3)
-                    weights.append(options.get(f"weight_{model_name}"))
-
-                elif model_name == "VitLarge":
-                    print(f'Processing vocals with {model_name} model...')
-                    vocals4, instrum4 = demix_full_vitlarge(mixed_sound_array.T, self.device, self.model_vl)#, self.config_vl, dim_t=512)
-                    vocals4 = match_array_shapes(vocals4, mixed_sound_array.T)
-                    vocals_model_outputs.append(vocals4)
-                    weights.append(options.get(f"weight_{model_name}"))
-
-                elif model_name == "VOCFT":
-                    print(f'Processing vocals with {model_name} model...')
-                    overlap = overlap_MDX
-                    sources1 = 0.5 * demix_wrapper(
-                        mixed_sound_array.T,
-                        self.device,
-                        self.mdx_models1,
-                        self.infer_session1,
-                        overlap=overlap,
-                        vc=1.021,
-                        bigshifts=options['BigShifts'] // 3
-                    )
-                    sources1 += 0.5 * -demix_wrapper(
-                        -mixed_sound_array.T,
-                        self.device,
-                        self.mdx_models1,
-                        self.infer_session1,
-                        overlap=overlap,
-                        vc=1.021,
-                        bigshifts=options['BigShifts'] // 3
-                    )
-                    vocals_mdxb1 = sources1
-                    vocals_model_outputs.append(vocals_mdxb1)
-                    weights.append(options.get(f"weight_{model_name}"))
-
-                elif model_name == "InstHQ4":
-                    print(f'Processing vocals with {model_name} model...')
-                    overlap = overlap_MDX
-                    sources2 = 0.5 * demix_wrapper(
-                        mixed_sound_array.T,
-                        self.device,
-                        self.mdx_models2,
-                        self.infer_session2,
-                        overlap=overlap,
-                        vc=1.019,
-                        bigshifts=options['BigShifts'] // 3
-                    )
-                    sources2 += 0.5 * -demix_wrapper(
-                        -mixed_sound_array.T,
-                        self.device,
-                        self.mdx_models2,
-                        self.infer_session2,
-                        overlap=overlap,
-                        vc=1.019,
-                        bigshifts=options['BigShifts'] // 3
-                    )
-                    vocals_mdxb2 = mixed_sound_array.T - sources2
-                    vocals_model_outputs.append(vocals_mdxb2)
-                    weights.append(options.get(f"weight_{model_name}"))
+        # Stages whose inputs and options didn't change since the last call on the same mix are not computed again
+        mix_key = audio_digest(mixed_sound_array)
+        self.stages.source('mix', mixed_sound_array, mix_key)
+        self.stages.source('mix_key', mix_key, mix_key)
 
-                else:
-                    # No more model to process or unknown one
-                    pass
-
-        print('Processing vocals: DONE!')
-        
-        vocals_combined = np.zeros_like(vocals_model_outputs[0])
-
-        for output, weight in zip(vocals_model_outputs, weights):
-            vocals_combined += output * weight
-
-        vocals_combined /= np.sum(weights)
-
-        vocals_low = lr_filter(vocals_combined.T, 12000, 'lowpass') # * 1.01055  # remember to check if new final finetuned volume compensation is needed  !
-        vocals_high = lr_filter(vocals3.T, 12000, 'highpass')
-        
-        vocals = vocals_low + vocals_high
-        #vocals = vocals_combined.T
-
-        if options['filter_vocals'] is True:
-                vocals = lr_filter(vocals, 50, 'highpass', order=8)
-        
-        # Generate instrumental
-        instrum = mixed_sound_array - vocals
-        
+        stages = sum(bool(options[f"use_{n}"]) for n in self.vocals_model_names)
         if options['vocals_only'] is False:
-            
-            """
-            print(f'Processing drums & bass with 2nd BS-Roformer model...')
-            other_bs2 = demix_full_bsrofo(instrum.T, self.device, self.model_bsrofoDB, self.config_bsrofoDB)
-            other_bs2 = match_array_shapes(other_bs2, mixed_sound_array.T)
-            drums_bass_bs2 = mixed_sound_array.T - other_bs2
-            
-            
-            print('Starting Demucs processing...')
-            
-            drums_bass_bs2 = np.expand_dims(drums_bass_bs2.T, axis=0)
-            drums_bass_bs2 = torch.from_numpy(drums_bass_bs2).type('torch.FloatTensor').to(self.device)
-            """
-            audio = np.expand_dims(instrum.T, axis=0)
-            audio = torch.from_numpy(audio).type('torch.FloatTensor').to(self.device)
-            all_outs = []
-            print('Processing with htdemucs_ft...')
-            i = 0
-            overlap = overlap_demucs
-            model = pretrained.get_model('htdemucs_ft')
-            model.to(self.device)
-            out = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy() \
-                  + 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-       
-            out[0] = self.weights_drums[i] * out[0]
-            out[1] = self.weights_bass[i] * out[1]
-            out[2] = self.weights_other[i] * out[2]
-            out[3] = self.weights_vocals[i] * out[3]
-            all_outs.append(out)
-            model = model.cpu()
-            del model
-            gc.collect()
-            i = 1
-            print('Processing with htdemucs...')
-            overlap = overlap_demucs
-            model = pretrained.get_model('htdemucs')
-            model.to(self.device)
-            out = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy() \
-                  + 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-    
-            out[0] = self.weights_drums[i] * out[0]
-            out[1] = self.weights_bass[i] * out[1]
-            out[2] = self.weights_other[i] * out[2]
-            out[3] = self.weights_vocals[i] * out[3]
-            all_outs.append(out)
-            model = model.cpu()
-            del model
-            gc.collect()
-            i = 2
-            print('Processing with htdemucs_6s...')
-            overlap = overlap_demucs
-            model = pretrained.get_model('htdemucs_6s')
-            model.to(self.device)
-            out = apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-       
-            # More stems need to add
-            out[2] = out[2] + out[4] + out[5]
-            out = out[:4]
-            out[0] = self.weights_drums[i] * out[0]
-            out[1] = self.weights_bass[i] * out[1]
-            out[2] = self.weights_other[i] * out[2]
-            out[3] = self.weights_vocals[i] * out[3]
-            all_outs.append(out)
-            model = model.cpu()
-            del model
-            gc.collect()
-            i = 3
-            print('Processing with htdemucs_mmi...')
-            model = pretrained.get_model('hdemucs_mmi')
-            model.to(self.device)
-            out = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy() \
-                  + 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-       
-            out[0] = self.weights_drums[i] * out[0]
-            out[1] = self.weights_bass[i] * out[1]
-            out[2] = self.weights_other[i] * out[2]
-            out[3] = self.weights_vocals[i] * out[3]
-            all_outs.append(out)
-            model = model.cpu()
-            del model
-            gc.collect()
-            out = np.array(all_outs).sum(axis=0)
-            out[0] = out[0] / self.weights_drums.sum()
-            out[1] = out[1] / self.weights_bass.sum()
-            out[2] = out[2] / self.weights_other.sum()
-            out[3] = out[3] / self.weights_vocals.sum()
-
-            # other
-            res = mixed_sound_array - vocals - out[0].T - out[1].T
-            res = np.clip(res, -1, 1)
-            separated_music_arrays['other'] = (2 * res + out[2].T) / 3.0
-            output_sample_rates['other'] = sample_rate
-    
-            # drums
-            res = mixed_sound_array - vocals - out[1].T - out[2].T
-            res = np.clip(res, -1, 1)
-            separated_music_arrays['drums'] = (res + 2 * out[0].T.copy()) / 3.0
-            output_sample_rates['drums'] = sample_rate
-    
-            # bass
-            res = mixed_sound_array - vocals - out[0].T - out[2].T
-            res = np.clip(res, -1, 1)
-            separated_music_arrays['bass'] = (res + 2 * out[1].T) / 3.0
-            output_sample_rates['bass'] = sample_rate
-    
-            bass = separated_music_arrays['bass']
-            drums = separated_music_arrays['drums']
-            other = separated_music_arrays['other']
-    
-            separated_music_arrays['other'] = mixed_sound_array - vocals - bass - drums
-            separated_music_arrays['drums'] = mixed_sound_array - vocals - bass - other
-            separated_music_arrays['bass'] = mixed_sound_array - vocals - drums - other
+            stages += len(self.demucs_model_names)
+        _progress.tracker = Progress(progress_callback, current_file_number, total_files, stages, memory_monitor)
+        profiler = Profiler(self.device) if options.get('profile', False) else None
+        if profiler is not None:
+            self.registry.start_profiling(profiler.folder)
+        _progress.profiler = profiler
+        finished = False
+        try:
+            with profiler if profiler is not None else contextlib.nullcontext():
+                vocals = self.stages.run('vocals', options)
+                instrum = self.stages.run('instrum', options)
+
+                if options['vocals_only'] is False:
+                    separated_music_arrays.update(self.stages.run('stems', options))
+                    for instrum_name in ('other', 'drums', 'bass'):
+                        output_sample_rates[instrum_name] = sample_rate
+            _progress.tracker.finish()
+            finished = True
+        finally:
+            # wall time and peak memory of every stage of the last call, see Progress
+            _progress.tracker.release()
+            self.timings = _progress.tracker.timings
+            _progress.tracker = None
+            # op-level profile of the last call, see Profiler
+            if profiler is not None:
+                profiler.onnx_traces = self.registry.end_profiling()
+                if not finished:
+                    # a failed call is not exported, its ONNX Runtime traces would stay behind
+                    profiler.close()
+                    profiler = None
+            self.profile = profiler
+            _progress.profiler = None
 
         # vocals
         separated_music_arrays['vocals'] = vocals
@@ -831,7 +1871,253 @@ class EnsembleDemucsMDXMusicSeparationModel:
         return separated_music_arrays, output_sample_rates
 
 
-def predict_with_model(options):
+@functools.lru_cache(maxsize=8)
+def resample_filter(up, down):
+    """ Low-pass taps for resample_poly, same design as its default window, built once per rate pair """
+    max_rate = max(up, down)
+    h = signal.firwin(2 * 10 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0)).astype(np.float32)
+    h.flags.writeable = False
+    return h
+
+
+def resample(audio, sr_from, sr_to):
+    """ Polyphase resampling of (channels, samples) audio, returns the input as is if the rates match """
+    if sr_from == sr_to:
+        return audio
+    g = math.gcd(sr_from, sr_to)
+    up, down = sr_to // g, sr_from // g
+    return resample_poly(audio, up, down, axis=-1, window=resample_filter(up, down)).astype(np.float32)
+
+
+def collect_stems(result, instruments, options):
+    """ Output stems in writing order, with the original gain restored if asked """
+    stems = collections.OrderedDict()
+    for instrum in instruments:
+        stems[instrum] = result[instrum]
+        if options["restore_gain"] is True: #restoring original gain
+            stems[instrum] = dBgain(stems[instrum], -options['input_gain'])
+
+    # instrumental part 1
+    # inst = (audio.T - result['vocals'])
+    stems['instrum'] = result['instrum']
+    if options["restore_gain"] is True: #restoring original gain
+        stems['instrum'] = dBgain(stems['instrum'], -options['input_gain'])
+
+    if options['vocals_only'] is False:
+        # instrumental part 2
+        stems['instrum2'] = stems['bass'] + stems['drums'] + stems['other']
+    return stems
+
+
+def separate_file_streaming(model, input_audio, output_folder, output_extension, output_format, options, current_file_number=0, total_files=0, progress_callback=None, timings=None):
+    """
+    Separates a long file block by block, so memory is bounded by the block size and not by the track length.
+    Every block is separated together with 'stream_context' seconds of audio around it, only the center
+    is kept. Neighbouring blocks are crossfaded inside the context, stems are appended to the output files.
+    Timing rows of every block (decode, model stages, writes) are appended to `timings` when it is given.
+    Returns the written paths
+    """
+    if timings is None:
+        timings = []
+    sr = 44100
+    with sf.SoundFile(input_audio) as f:
+        sr_in, total = f.samplerate, f.frames
+        g = math.gcd(sr, sr_in)
+        up, down = sr // g, sr_in // g
+        # block borders are multiples of 'down' so they land on exact output samples
+        block = max(1, int(options['stream_seconds'] * sr_in) // down) * down
+        context = max(1, int(options.get('stream_context', 15) * sr_in) // down) * down
+        fade = min(context * up // down, sr) // 2
+
+        def out_pos(x):
+            return -(-x * up // down)
+
+        def read(win_start, win_end):
+            f.seek(win_start)
+            audio = f.read(win_end - win_start, dtype='float32', always_2d=True).T
+            if audio.shape[0] == 1:
+                audio = np.concatenate([audio, audio], axis=0)
+            audio = audio[:2]
+            audio = resample(audio, sr_in, sr)
+            if options['input_gain'] != 0:
+                audio = dBgain(audio, options['input_gain'])
+            return audio
+
+        writers = {}
+        tail = None
+        try:
+            starts = range(0, total, block)
+            for k, start in enumerate(starts):
+                end = min(start + block, total)
+                win_start, win_end = max(0, start - context), min(total, end + context)
+                audio, decode = timed_call(read, win_start, win_end)
+                timings.append(dict(decode, name='decode', chunks=None))
+
+                print('Block {}/{}: {:.1f}-{:.1f} sec'.format(k + 1, len(starts), start / sr_in, end / sr_in))
+                result, _ = model.separate_music_file(audio.T, sr, current_file_number, total_files, progress_callback)
+                timings += model.timings
+                if model.profile is not None:
+                    prefix = output_folder + '/' + os.path.splitext(os.path.basename(input_audio))[0] + '_block{}'.format(k + 1)
+                    for path in model.profile.export(prefix, options.get('profile_top', 20)):
+                        print('Profile written: {}'.format(path))
+                    model.profile = None
+                stems = collect_stems(result, model.instruments, options)
+
+                a = out_pos(start) - out_pos(win_start)
+                b = out_pos(end) - out_pos(win_start)
+                fade_in = np.linspace(0, 1, fade, endpoint=False, dtype=np.float32)[:, None]
+                next_tail = {}
+                for name, stem in stems.items():
+                    if name not in writers:
+                        output_name = os.path.splitext(os.path.basename(input_audio))[0] + '_{}.{}'.format(name, output_extension)
+                        writers[name] = sf.SoundFile(output_folder + '/' + output_name, 'w', samplerate=sr, channels=2, subtype=output_format)
+                    center = stem[a:b].copy()
+                    if tail is not None:
+                        n = min(fade, len(center))
+                        center[:n] = center[:n] * fade_in[:n] + tail[name][:n] * (1 - fade_in[:n])
+                    next_tail[name] = stem[b:b + fade]
+                    _, write = timed_call(writers[name].write, center)
+                    timings.append(dict(write, name='write {}'.format(name), chunks=None))
+                tail = next_tail
+        finally:
+            for name, w in writers.items():
+                w.close()
+                print('File created: {}'.format(w.name))
+    return [w.name for w in writers.values()]
+
+
+def load_input(input_audio, options):
+    """
+    Decodes a file to a (2, samples) array at 44100 Hz with the input gain applied.
+    Returns (audio, 44100, sample rate of the file)
+    """
+    sr = 44100
+    try:
+        audio, sr_in = sf.read(input_audio, dtype='float32', always_2d=True)
+        audio = audio.T
+    except RuntimeError:
+        # formats libsndfile can't read
+        audio, sr_in = librosa.load(input_audio, mono=False, sr=None)
+        audio = np.atleast_2d(audio)
+    if audio.shape[0] == 1:
+        audio = np.concatenate([audio, audio], axis=0)
+    audio = resample(audio, sr_in, sr)
+
+    if options['input_gain'] != 0:
+        audio = dBgain(audio, options['input_gain'])
+    return audio, sr, sr_in
+
+
+def write_stems(stems, sample_rates, sr, input_audio, output_folder, output_extension, output_format, output_sr=None):
+    """ Writes every stem next to each other, returns the written paths and a timing row of every file """
+    paths = []
+    rows = []
+    for instrum, stem in stems.items():
+        output_name = os.path.splitext(os.path.basename(input_audio))[0] + '_{}.{}'.format(instrum, output_extension)
+        rate = sample_rates.get(instrum, sr)
+
+        def write(stem, rate):
+            if output_sr is not None and output_sr != rate:
+                stem, rate = resample(stem.T, rate, output_sr).T, output_sr
+            sf.write(output_folder + '/' + output_name, stem, rate, subtype=output_format)
+        _, row = timed_call(write, stem, rate)
+        rows.append(dict(row, name='write {}'.format(instrum), chunks=None))
+        print('File created: {}'.format(output_folder + '/' + output_name))
+        paths.append(output_folder + '/' + output_name)
+    return paths, rows
+
+
+def timed_call(fn, *args):
+    """ Returns (fn(*args), timing row fields: wall time in seconds and peak memory of the process) """
+    start = time()
+    interval = memory_monitor.open()
+    try:
+        result = fn(*args)
+    finally:
+        memory = memory_monitor.close(interval)
+    return result, dict(memory, seconds=time() - start)
+
+
+def peak_memory(rows):
+    """ Highest peak_rss_mb and peak_cuda_mb of timing rows """
+    peaks = {}
+    for key in ('peak_rss_mb', 'peak_cuda_mb'):
+        values = [t[key] for t in rows if t.get(key) is not None]
+        peaks[key] = max(values) if values else None
+    return peaks
+
+
+def timing_report(name, duration, timings):
+    """ Stage timings and peak memory of a track with real-time factors (stage time / audio duration) and the total """
+    stages = [dict(t, rtf=t['seconds'] / duration if duration else None) for t in timings]
+    total = sum(t['seconds'] for t in timings if 'model' not in t)
+    report = {'track': name, 'duration': duration, 'seconds': total, 'rtf': total / duration if duration else None, 'stages': stages}
+    report.update(peak_memory(timings))
+    return report
+
+
+def merge_timings(timings):
+    """ Rows of the same name merged into one: seconds and chunks added up, highest peak memory """
+    merged = collections.OrderedDict()
+    for t in timings:
+        m = merged.get(t['name'])
+        if m is None:
+            merged[t['name']] = dict(t)
+            continue
+        m['seconds'] += t['seconds']
+        if t['chunks'] is not None:
+            m['chunks'] = (m['chunks'] or 0) + t['chunks']
+        m.update(peak_memory([m, t]))
+    return list(merged.values())
+
+
+def aggregate_report(reports):
+    """ Stage timings summed over all tracks of a batch """
+    stages = collections.OrderedDict()
+    for report in reports:
+        for t in report['stages']:
+            s = stages.setdefault(t['name'], dict(t, seconds=0.0, chunks=None, tracks=0))
+            s['seconds'] += t['seconds']
+            s['tracks'] += 1
+            if t['chunks'] is not None:
+                s['chunks'] = (s['chunks'] or 0) + t['chunks']
+            s.update(peak_memory([s, t]))
+    duration = sum(r['duration'] for r in reports)
+    total = sum(r['seconds'] for r in reports)
+    for s in stages.values():
+        s['rtf'] = s['seconds'] / duration if duration else None
+    report = {'tracks': len(reports), 'duration': duration, 'seconds': total, 'rtf': total / duration if duration else None,
+              'stages': list(stages.values())}
+    report.update(peak_memory(reports))
+    return report
+
+
+def write_reports(reports, output_folder):
+    """ <track>_report.json of every track and the aggregate report.json, reports - input file -> (duration, timings) """
+    track_reports = []
+    for input_audio, (duration, timings) in reports.items():
+        report = timing_report(input_audio, duration, timings)
+        track_reports.append(report)
+        output_name = os.path.splitext(os.path.basename(input_audio))[0] + '_report.json'
+        with open(output_folder + '/' + output_name, 'w') as f:
+            json.dump(report, f, indent=2)
+    total = aggregate_report(track_reports)
+    with open(output_folder + '/report.json', 'w') as f:
+        json.dump(total, f, indent=2)
+    print('Stage timings (real-time factor over {:.1f} sec of audio):'.format(total['duration']))
+    for s in total['stages']:
+        peak = ' peak {:8.1f} MB'.format(s['peak_rss_mb']) if s.get('peak_rss_mb') is not None else ''
+        print('    {:<40} {:8.2f} sec  RTF {:.3f}{}'.format(s['name'], s['seconds'], s['rtf'] or 0, peak))
+    print('Report written: {}'.format(output_folder + '/report.json'))
+
+
+def predict_with_model(options, model=None, progress_callback=None):
+    """
+    Separates every file of options['input_audio'] into options['output_folder'].
+    An already built model can be passed to keep its loaded models between calls,
+    progress_callback gets the progress of every track, see Progress.
+    Returns input file -> list of written stems, None if an input is missing
+    """
 
     output_format = options['output_format']
     output_extension = 'flac' if output_format == 'FLAC' else "wav"
@@ -840,51 +2126,88 @@ def predict_with_model(options):
     for input_audio in options['input_audio']:
         if not os.path.isfile(input_audio):
             print('Error. No such file: {}. Please check path!'.format(input_audio))
-            return
+            return None
     output_folder = options['output_folder']
     if not os.path.isdir(output_folder):
         os.mkdir(output_folder)
 
-    model = None
-    model = EnsembleDemucsMDXMusicSeparationModel(options)
-
-    for i, input_audio in enumerate(options['input_audio']):
-        print('Go for: {}'.format(input_audio))
-        audio, sr = librosa.load(input_audio, mono=False, sr=44100)
-        if len(audio.shape) == 1:
-            audio = np.stack([audio, audio], axis=0)
-        
-        
-        if options['input_gain'] != 0:
-            audio = dBgain(audio, options['input_gain'])
-
-        print("Input audio: {} Sample rate: {}".format(audio.shape, sr))
-        result, sample_rates = model.separate_music_file(audio.T, sr, i, len(options['input_audio']))
-        
-        for instrum in model.instruments:
-            output_name = os.path.splitext(os.path.basename(input_audio))[0] + '_{}.{}'.format(instrum, output_extension)
-            if options["restore_gain"] is True: #restoring original gain
-                result[instrum] = dBgain(result[instrum], -options['input_gain'])
-            sf.write(output_folder + '/' + output_name, result[instrum], sample_rates[instrum], subtype=output_format)
-            print('File created: {}'.format(output_folder + '/' + output_name))
-
-        # instrumental part 1
-        # inst = (audio.T - result['vocals'])
-        inst = result['instrum']
-
-        if options["restore_gain"] is True: #restoring original gain
-            inst = dBgain(inst, -options['input_gain'])
-
-        output_name = os.path.splitext(os.path.basename(input_audio))[0] + '_{}.{}'.format('instrum', output_extension)
-        sf.write(output_folder + '/' + output_name, inst, sr, subtype=output_format)
-        print('File created: {}'.format(output_folder + '/' + output_name))
-        
-        if options['vocals_only'] is False:
-            # instrumental part 2
-            inst2 = (result['bass'] + result['drums'] + result['other'])
-            output_name = os.path.splitext(os.path.basename(input_audio))[0] + '_{}.{}'.format('instrum2', output_extension)
-            sf.write(output_folder + '/' + output_name, inst2, sr, subtype=output_format)
-            print('File created: {}'.format(output_folder + '/' + output_name))
+    files = options['input_audio']
+    written = collections.OrderedDict()
+    reports = collections.OrderedDict()
+    # once for all files, a ceiling breach seen by a decode thread must not be reset
+    memory_monitor.configure(options)
+
+    if options.get('stream_seconds', 0) > 0:
+        if model is None:
+            model = EnsembleDemucsMDXMusicSeparationModel(options)
+        for i, input_audio in enumerate(files):
+            print('Go for: {}'.format(input_audio))
+            timings = []
+            written[input_audio] = separate_file_streaming(model, input_audio, output_folder, output_extension, output_format, options, i, len(files), progress_callback, timings)
+            # every block has its own rows, the report has one row per stage for the whole file
+            reports[input_audio] = (sf.info(input_audio).duration, merge_timings(timings))
+        if options.get('report', False):
+            write_reports(reports, output_folder)
+        return written
+
+    # Upcoming files are decoded and finished stems are written in background threads while the model runs.
+    # At most io_workers files wait decoded and io_workers tracks wait to be written.
+    io_workers = max(1, int(options.get('io_workers', 2)))
+    cache = None
+    if options.get('cache_dir'):
+        cache = ResultCache(options['cache_dir'], int(float(options.get('cache_size', 0)) * 1024 ** 3))
+    with ThreadPoolExecutor(io_workers) as decode_pool, ThreadPoolExecutor(io_workers) as encode_pool:
+        decodes = collections.deque()
+        writes = collections.deque()
+        for i, input_audio in enumerate(files):
+            while len(decodes) < io_workers and i + len(decodes) < len(files):
+                decodes.append(decode_pool.submit(timed_call, load_input, files[i + len(decodes)], options))
+            (audio, sr, sr_in), decode = decodes.popleft().result()
+            timings = [dict(decode, name='decode', chunks=None)]
+            memory_monitor.check('decode of {}'.format(input_audio))
+            duration = audio.shape[-1] / sr
+
+            print('Go for: {}'.format(input_audio))
+            print("Input audio: {} Sample rate: {}".format(audio.shape, sr))
+            start = time()
+            key = cache.key(audio, options) if cache is not None else None
+            cached = cache.get(key) if cache is not None else None
+            if cached is not None:
+                print('Found in cache: {}'.format(key))
+                stems, sample_rates = cached
+                result = None
+                timings.append({'name': 'result cache', 'seconds': time() - start, 'chunks': None})
+            else:
+                # models are only loaded once something has to be separated
+                if model is None:
+                    model = EnsembleDemucsMDXMusicSeparationModel(options)
+                result, sample_rates = model.separate_music_file(audio.T, sr, i, len(files), progress_callback)
+                timings += model.timings
+                if model.profile is not None:
+                    track = os.path.splitext(os.path.basename(input_audio))[0]
+                    for path in model.profile.export(output_folder + '/' + track, options.get('profile_top', 20)):
+                        print('Profile written: {}'.format(path))
+                    model.profile = None
+                stems = collect_stems(result, model.instruments, options)
+                if cache is not None:
+                    writes.append(encode_pool.submit(cache.put, key, stems, sample_rates))
+            del audio
+
+            output_sr = sr_in if options.get('keep_input_rate', False) else None
+            written[input_audio] = encode_pool.submit(write_stems, stems, sample_rates, sr, input_audio, output_folder, output_extension, output_format, output_sr)
+            writes.append(written[input_audio])
+            reports[input_audio] = (duration, timings)
+            del result, stems
+            while len(writes) > io_workers:
+                writes.popleft().result()
+        for w in writes:
+            w.result()
+
+    if options.get('report', False):
+        for input_audio, (duration, timings) in reports.items():
+            timings += written[input_audio].result()[1]
+        write_reports(reports, output_folder)
+    return collections.OrderedDict((input_audio, w.result()[0]) for input_audio, w in written.items())
 
 
 # Linkwitz-Riley filter
@@ -912,9 +2235,7 @@ def dBgain(audio, volume_gain_dB):
 
 
 
-if __name__ == '__main__':
-    start_time = time()
-    print("started!\n")
+def build_parser():
     m = argparse.ArgumentParser()
     m.add_argument("--input_audio", "-i", nargs='+', type=str, help="Input audio location. You can provide multiple files at once", required=True)
     m.add_argument("--output_folder", "-r", type=str, help="Output audio folder", required=True)
@@ -933,6 +2254,30 @@ if __name__ == '__main__':
     m.add_argument("--weight_VitLarge", type=float, help="Weight of VitLarge model", required=False, default=1)
     m.add_argument("--weight_BSRoformer", type=float, help="Weight of BS-Roformer model", required=False, default=10)
     m.add_argument("--BigShifts", type=int, help="Managing MDX 'BigShifts' trick value.", required=False, default=3)
+    m.add_argument("--batch_size", type=int, help="Number of chunks processed per forward pass for BSRoformer and InstVoc. Higher - faster, but needs more memory", required=False, default=1)
+    m.add_argument("--batch_size_onnx", type=int, help="Number of chunks processed per ONNX run for VOCFT and InstHQ4. Higher - better CPU usage, but needs more memory", required=False, default=1)
+    m.add_argument("--overlap_norm", type=str, choices=['counter', 'analytic'], help="How overlapping chunks are normalized. 'analytic' computes window sums from the chunk plan and saves one full length buffer per model", required=False, default='counter')
+    m.add_argument("--single_pass_shifts", action='store_true', help="Run all BigShifts copies through each model in shared batches with one accumulator (uses analytic overlap normalization)")
+    m.add_argument("--polarity_batch", action='store_true', help="Run both polarities of the sign-flip trick as one batch (VOCFT, InstHQ4 and Demucs), the spectrogram is computed only once")
+    m.add_argument("--models_memory_limit", type=float, help="GB of device memory for vocals models. Least recently used models are evicted when it's exceeded, 0 - no limit", required=False, default=0)
+    m.add_argument("--evict_to", type=str, choices=['cpu', 'disk'], help="Where evicted models go: moved to CPU memory or dropped and reloaded from disk", required=False, default='cpu')
+    m.add_argument("--stream_seconds", type=float, help="Separate long inputs in blocks of this many seconds and write stems as they are ready, memory stays bounded by the block size. 0 - off", required=False, default=0)
+    m.add_argument("--stream_context", type=float, help="Seconds of audio separated on each side of a streaming block, used to crossfade neighbouring blocks", required=False, default=15)
+    m.add_argument("--io_workers", type=int, help="Threads decoding upcoming files and writing finished stems while the model runs, also how many tracks may wait in each queue", required=False, default=2)
+    m.add_argument("--keep_input_rate", action='store_true', help="Write stems at the sample rate of the input file instead of 44100 Hz (not in streaming mode)")
+    m.add_argument("--cache_dir", type=str, help="Folder for cached separation results. Audio already separated with the same options is written from the cache without loading models (not in streaming mode)", required=False, default=None)
+    m.add_argument("--cache_size", type=float, help="GB limit of the result and stem caches, least recently used results are removed above it. 0 - no limit", required=False, default=10)
+    m.add_argument("--stem_cache_dir", type=str, help="Folder for cached raw outputs of each model. Runs that only change weights, crossover or vocals filter reuse them instead of running the models again", required=False, default=None)
+    m.add_argument("--recombine_only", action='store_true', help="Only recombine outputs from --stem_cache_dir with the given weights, fail instead of running a model whose output isn't cached. Demucs runs on the mix minus the vocals, so in 4-stem mode only --demucs_weights_* can change, use it with --vocals_only to change vocals weights, crossover or filter")
+    for stem, default in DEMUCS_WEIGHTS.items():
+        m.add_argument(f"--demucs_weights_{stem}", type=float, nargs=4, help=f"Weights of htdemucs_ft, htdemucs, htdemucs_6s and hdemucs_mmi for {stem} in 4-stem mode", required=False, default=list(default))
+    m.add_argument("--crossover", type=int, help="Frequency in Hz above which vocals come from InstVoc alone", required=False, default=12000)
+    m.add_argument("--report", action='store_true', help="Write per stage wall time, real-time factor, chunk counts and peak memory as <track>_report.json and an aggregate report.json to the output folder. In streaming mode the rows of all blocks of a file are added up")
+    m.add_argument("--profile", action='store_true', help="Profile every model call with torch.profiler and ONNX Runtime. Writes <track>_trace.json (Chrome trace, opens in Perfetto), <track>_<model>_onnx_trace.json and the top operators of every model to <track>_profile.txt. Slow with large traces, use short excerpts. In streaming mode every block gets its own files")
+    m.add_argument("--profile_top", type=int, help="Operators per model in <track>_profile.txt", required=False, default=20)
+    m.add_argument("--memory_ceiling", type=float, help="GB of anonymous resident memory (page cache of memory-mapped files like --spill_dir not included) above which the separation stops with an error instead of being killed by the OS, checked after every batch of chunks. 0 - no limit", required=False, default=0)
+    m.add_argument("--cuda_memory_ceiling", type=float, help="GB of allocated CUDA memory above which the separation stops with an error. 0 - no limit", required=False, default=0)
+    m.add_argument("--spill_dir", type=str, help="Keep full length intermediate stems in memory mapped files in this folder instead of RAM, useful for long tracks with little memory", required=False, default=None)
     m.add_argument("--vocals_only",  action='store_true', help="Vocals + instrumental only")
     m.add_argument("--use_BSRoformer", action='store_true', help="use BSRoformer in vocal ensemble")
     m.add_argument("--BSRoformer_model", type=str, help="Which checkpoint to use", required=False, default="ep_317_1297")
@@ -944,12 +2289,24 @@ if __name__ == '__main__':
     m.add_argument("--input_gain", type=int, help="input volume gain", required=False, default=0)
     m.add_argument("--restore_gain", action='store_true', help="restore original gain after separation")
     m.add_argument("--filter_vocals", action='store_true', help="Remove audio below 50hz in vocals stem")
-    options = m.parse_args().__dict__
+    return m
+
+
+if __name__ == '__main__':
+    start_time = time()
+    print("started!\n")
+    options = build_parser().parse_args().__dict__
     print("Options: ")
 
     print(f'Input Gain: {options["input_gain"]}dB')
     print(f'Restore Gain: {options["restore_gain"]}')
-    print(f'BigShifts: {options["BigShifts"]}\n')
+    print(f'BigShifts: {options["BigShifts"]}')
+    print(f'batch_size: {options["batch_size"]}')
+    print(f'batch_size_onnx: {options["batch_size_onnx"]}')
+    print(f'overlap_norm: {options["overlap_norm"]}')
+    print(f'single_pass_shifts: {options["single_pass_shifts"]}')
+    print(f'polarity_batch: {options["polarity_batch"]}')
+    print(f'stream_seconds: {options["stream_seconds"]}\n')
 
     print(f'BSRoformer_model: {options["BSRoformer_model"]}')
     print(f'weight_BSRoformer: {options["weight_BSRoformer"]}')
@@ -0,0 +1,123 @@
+# coding: utf-8
+"""
+Separation server: models are loaded once and stay in memory between jobs.
+
+    python server.py --port 8023 [any inference.py option, used as default for all jobs]
+
+    POST /jobs       JSON with "input_audio" (list of paths), "output_folder" and any inference.py option,
+                     returns {"id": ...}
+    GET  /jobs/<id>  job state (queued, running, done or failed), the last progress report of a running job
+                     (see inference.Progress) and the written stems or the error
+    GET  /jobs       all jobs
+
+Jobs run one at a time in the order they came in.
+"""
+import argparse
+import json
+import queue
+import threading
+import traceback
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import inference
+
+# Options tied to the loaded models, they are set when the server starts and jobs can't change them
+SERVER_OPTIONS = inference.MODEL_OPTIONS
+
+
+class SeparationServer:
+    def __init__(self, defaults):
+        self.defaults = defaults
+        inference.options = dict(defaults)
+        self.model = inference.EnsembleDemucsMDXMusicSeparationModel(inference.options)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    def submit(self, job_options):
+        if not job_options.get('input_audio') or not job_options.get('output_folder'):
+            raise ValueError('input_audio and output_folder are required')
+        if isinstance(job_options['input_audio'], str):
+            job_options['input_audio'] = [job_options['input_audio']]
+        options = dict(self.defaults)
+        options.update({k: v for k, v in job_options.items() if k not in SERVER_OPTIONS})
+        job = {'id': uuid.uuid4().hex, 'state': 'queued', 'input_audio': options['input_audio'], 'progress': None,
+               'files': None, 'error': None}
+        with self.lock:
+            self.jobs[job['id']] = job
+        self.queue.put((job, options))
+        return job
+
+    def worker(self):
+        while True:
+            job, options = self.queue.get()
+            job['state'] = 'running'
+            try:
+                # the model reads the module options, jobs run one at a time so they can be swapped per job
+                inference.options = options
+                written = inference.predict_with_model(options, self.model, lambda info: job.update(progress=info))
+                if written is None:
+                    raise FileNotFoundError('Missing input file in {}'.format(options['input_audio']))
+                job['files'] = written
+                job['state'] = 'done'
+            except Exception as e:
+                traceback.print_exc()
+                job['error'] = repr(e)
+                job['state'] = 'failed'
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def all(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+
+def make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            parts = self.path.strip('/').split('/')
+            if parts == ['jobs']:
+                self.reply(200, server.all())
+            elif len(parts) == 2 and parts[0] == 'jobs' and server.get(parts[1]) is not None:
+                self.reply(200, server.get(parts[1]))
+            else:
+                self.reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path.strip('/') != 'jobs':
+                self.reply(404, {'error': 'not found'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                job = server.submit(body)
+            except (ValueError, TypeError, AttributeError) as e:
+                self.reply(400, {'error': str(e)})
+                return
+            self.reply(202, job)
+
+    return Handler
+
+
+if __name__ == '__main__':
+    m = argparse.ArgumentParser(description='Separation server, other options are passed to inference.py as defaults for all jobs')
+    m.add_argument("--host", type=str, help="Address to listen on", default='127.0.0.1')
+    m.add_argument("--port", type=int, help="Port to listen on", default=8023)
+    args, rest = m.parse_known_args()
+    defaults = inference.build_parser().parse_args(['--input_audio', '', '--output_folder', ''] + rest).__dict__
+
+    server = SeparationServer(defaults)
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(server))
+    print('Listening on http://{}:{}'.format(args.host, args.port))
+    httpd.serve_forever()
@@ -32,6 +32,18 @@ def path_output(input_file, output_folder, vocals_only, format):
             files.append(other)
     return files
 
+# Separation models by the options they were built with, so their loaded models are reused between clicks
+models = {}
+
+
+def get_model(options):
+    key = tuple(options.get(k) for k in inference.MODEL_OPTIONS)
+    if key not in models:
+        models.clear()
+        models[key] = inference.EnsembleDemucsMDXMusicSeparationModel(options)
+    return models[key]
+
+
 def main():
     css = """
 .button {
@@ -228,6 +240,10 @@ def main():
 
                     single_onnx = gr.Checkbox(
                         label="Use single onnx")
+
+                    cache_outputs = gr.Checkbox(
+                        label="Cache model outputs in cache/stems, up to 10 GB (weight changes reuse them)",
+                        value=False)
         with gr.Group(elem_classes=["button"]):
             separate_button = gr.Button(value="Separate")
 
@@ -261,7 +277,8 @@ def main():
             output_format,
             input_gain,
             restore_gain,
-            filter_vocals
+            filter_vocals,
+            cache_outputs
         ], outputs=audio_output)
         def handle_separate(input_audio,
                             output_folder,
@@ -290,7 +307,9 @@ def main():
                             output_format,
                             input_gain,
                             restore_gain,
-                            filter_vocals):
+                            filter_vocals,
+                            cache_outputs,
+                            progress=gr.Progress()):
             options = {
                 "input_audio": [input_audio],
                 "output_folder": output_folder,
@@ -320,10 +339,16 @@ def main():
                 "input_gain": input_gain,
                 "restore_gain": restore_gain,
                 "filter_vocals": filter_vocals,
+                "stem_cache_dir": os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "stems") if cache_outputs else None,
+                "cache_size": 10,
             }
             print(options)
             inference.options = options
-            inference.predict_with_model(options)
+            def report(info):
+                eta = '' if info['eta'] is None else ', {:.0f}s left'.format(info['eta'])
+                progress(info['progress'], desc='{}{}'.format(info['model'] or 'Done', eta))
+
+            inference.predict_with_model(options, get_model(options), report)
 
 
             return path_output(input_audio, output_folder, True if separation_mode == 'Vocal/Instrumental' else False ,output_format)